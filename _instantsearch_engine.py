@@ -0,0 +1,2016 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Search engine of the Instant Search plugin. Edvard Rejthar
+# https://github.com/e3rd/zim-plugin-instantsearch
+#
+# The engine depends neither on Zim nor on GTK so that the search might be profiled,
+# run in the worker processes or used without the Zim GUI. The plugin is just a thin GUI layer above.
+# It is a module next to the plugin folder, not in it: importing a module from the plugin package
+# would run the package __init__ that imports GTK and Zim. Its name starts with an underscore
+# so that Zim does not list it among the plugins.
+#
+import logging
+from array import array
+from bisect import bisect_left, bisect_right
+import multiprocessing
+import os
+from os.path import abspath, normcase
+import re
+import sqlite3
+from collections import Counter, OrderedDict, defaultdict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from functools import lru_cache
+from heapq import nlargest
+from itertools import accumulate, islice
+from math import ceil
+from pathlib import Path
+from threading import RLock
+from time import perf_counter, time
+from typing import Any, Callable, DefaultDict, Dict, Generator, Iterable, List, NamedTuple, Optional, Pattern, Set, \
+    Tuple, Union
+from urllib.parse import unquote
+
+logger = logging.getLogger('zim.plugins.instantsearch')
+
+ZimPath = Any  # zim.notebook.Path when run by the plugin, the page name otherwise
+ZimPathStr = str  # may serve as an argument to the ZimPath constructor
+
+
+# regex to identify inner link contents
+link = re.compile(r"\[\[(.*?)\]\]", re.IGNORECASE)  # matches all links "economi[[inserted link]]cal"
+
+
+class PageText:
+    """ Page contents prepared for the fulltext search so that the query terms might be found by a plain str.find.
+
+        Links are pulled out "economi[[inserted link]]cal" -> "economical" + "inserted link",
+        markup characters the search ignores are stripped and the text is lowered.
+        Offsets of the normalized characters in the original contents are kept.
+    """
+    __slots__ = "body", "links", "headings", "_norm_starts", "_body_starts", "_link_positions", "_link_lengths"
+
+    markup = re.compile(r"[*/'_~]")  # strip markup: **bold**, //italic//,  __underline__, ''verbatim'', ~~strike~~
+    not_markup = re.compile(r"[^*/'_~]+")
+    heading = re.compile(r"\n=+ ")
+
+    def __init__(self, contents: str):
+        # body without links (contents from now on)
+        links, pieces, last = [], [], 0
+        self._link_positions = []  # where in the body the links were pulled out
+        self._link_lengths = []  # cumulative length of the links pulled out
+        for m in link.finditer(contents):
+            pieces.append(contents[last:m.start()])
+            links.append(m.group(1))
+            self._link_positions.append(m.start() - (self._link_lengths[-1] if self._link_lengths else 0))
+            self._link_lengths.append((self._link_lengths[-1] if self._link_lengths else 0) + m.end() - m.start())
+            last = m.end()
+        pieces.append(contents[last:])
+        body = "".join(pieces)
+
+        # normalized body, every chunk of it starts at self._norm_starts[i] and comes from self._body_starts[i]
+        norm = []
+        self._norm_starts, self._body_starts = array("l"), array("l")
+        length = 0
+        for m in self.not_markup.finditer(body):
+            chunk = m.group(0)
+            lowered = chunk.lower()
+            if len(lowered) == len(chunk):
+                self._norm_starts.append(length)
+                self._body_starts.append(m.start())
+            else:  # a letter got longer when lowered, ex: 'İ'
+                lowered = ""
+                for i, c in enumerate(chunk, m.start()):
+                    for c2 in c.lower():
+                        self._norm_starts.append(length + len(lowered))
+                        self._body_starts.append(i)
+                        lowered += c2
+            norm.append(lowered)
+            length += len(lowered)
+        self.body = "".join(norm)
+        self.links = self.markup.sub("", "".join(links).lower())
+
+        # headings (start of the line, end of the '=' signs prefix, end of the line) in the normalized body
+        self.headings = []
+        for m in self.heading.finditer(body):
+            line_end = body.find("\n", m.end())
+            self.headings.append((self._norm_index(m.start()), self._norm_index(m.end()),
+                                  self._norm_index(len(body) if line_end == -1 else line_end)))
+
+    def _norm_index(self, body_index: int) -> int:
+        """ Index of the first normalized character coming from the body index or later. """
+        i = bisect_right(self._body_starts, body_index) - 1
+        if i < 0:
+            return 0
+        norm_index = self._norm_starts[i] + body_index - self._body_starts[i]
+        chunk_end = self._norm_starts[i + 1] if i + 1 < len(self._norm_starts) else len(self.body)
+        return min(norm_index, chunk_end)
+
+    def body_offset(self, norm_index: int) -> int:
+        """ Offset in the contents without links of the normalized character. """
+        i = bisect_right(self._norm_starts, norm_index) - 1
+        return self._body_starts[i] + norm_index - self._norm_starts[i]
+
+    def offset(self, norm_index: int) -> int:
+        """ Offset in the original contents of the normalized character. """
+        body_offset = self.body_offset(norm_index)
+        i = bisect_right(self._link_positions, body_offset)
+        return body_offset + (self._link_lengths[i - 1] if i else 0)
+
+    def size(self):
+        """ Approximate memory size. """
+        return len(self.body) + len(self.links) + 8 * (len(self._norm_starts) + len(self._link_positions))
+
+    def dump(self) -> bytes:
+        """ Compact binary form to be stored on the disk, see load.
+            The offsets are 32-bit, pages are smaller than 2 GB. """
+        body, links = self.body.encode(), self.links.encode()
+        numbers = array("i", (len(body), len(links), len(self._norm_starts), len(self._link_positions),
+                              len(self.headings)))
+        for offsets in (self._norm_starts, self._body_starts, self._link_positions, self._link_lengths):
+            numbers.fromlist(list(offsets))
+        for heading in self.headings:
+            numbers.extend(heading)
+        return numbers.tobytes() + body + links
+
+    @classmethod
+    def load(cls, data: bytes) -> "PageText":
+        """ Restore the dumped text without parsing the contents again. """
+        numbers = array("i")
+        numbers.frombytes(data[:5 * numbers.itemsize])
+        body_size, links_size, chunks, link_count, heading_count = numbers
+        count = 5 + 2 * chunks + 2 * link_count + 3 * heading_count
+        numbers.frombytes(data[5 * numbers.itemsize:count * numbers.itemsize])
+        text = data[count * numbers.itemsize:]
+
+        self = cls.__new__(cls)
+        self.body = text[:body_size].decode()
+        self.links = text[body_size:body_size + links_size].decode()
+        i = 5
+        self._norm_starts = array("l", numbers[i:i + chunks])
+        self._body_starts = array("l", numbers[i + chunks:i + 2 * chunks])
+        i += 2 * chunks
+        self._link_positions = list(numbers[i:i + link_count])
+        self._link_lengths = list(numbers[i + link_count:i + 2 * link_count])
+        i += 2 * link_count
+        self.headings = [tuple(numbers[j:j + 3]) for j in range(i, i + 3 * heading_count, 3)]
+        return self
+
+    def score(self, q: str, offsets: Optional[array] = None) -> int:
+        """ Count the occurrences of the query term, the ones in the headings get more points.
+            Gives the same score as the regex "(\\n=+ .*)?" + letter_split(q) run on the contents without links:
+            the heading match is counted from the line start till the last occurrence of the term on that line.
+            :param offsets: the normalized indices of the occurrences counted are appended to it
+        """
+        body, headings, score, pos, h = self.body, self.headings, 0, 0, 0
+        while True:
+            found = body.find(q, pos)
+            while h < len(headings) and headings[h][0] < pos:
+                h += 1
+            # headings before the found occurrence
+            while h < len(headings) and (found == -1 or headings[h][0] < found):
+                start, prefix_end, line_end = headings[h]
+                h += 1
+                last = body.rfind(q, prefix_end, line_end)
+                if last != -1:
+                    score += (self.body_offset(last) - self.body_offset(start)) * 3
+                    pos = last + len(q)
+                    if offsets is not None:
+                        offsets.append(last)
+                    break
+            else:
+                if found == -1:
+                    return score
+                score += 1
+                pos = found + len(q)
+                if offsets is not None:
+                    offsets.append(found)
+
+
+class _FileCache(NamedTuple):
+    path: ZimPath
+    contents: str
+    text: PageText
+    mtime: int  # st_mtime_ns of the file when read
+    size: int  # st_size of the file when read
+
+
+class PageStore:
+    """ On-disk copy of the page contents cache, stored in the notebook cache folder, kept between Zim runs.
+
+        For every page file read, we store its contents and its PageText with the file mtime and size,
+        so that the first search after Zim starts does not have to read and parse all the pages again.
+        A stored page is used only if its file has not changed since.
+    """
+    flush_count = 256  # number of the pages written at once
+
+    def __init__(self, db_path: Path, readonly=False):
+        """ :param readonly: pages are not written, ex: in the worker processes of the parallel search """
+        self.db_path = db_path
+        self.readonly = readonly
+        self._db: Optional[sqlite3.Connection] = None
+        self._pending: Dict[Path, tuple] = {}
+        self._lock = RLock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if not self._db:
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(str(self.db_path), check_same_thread=False, timeout=1)
+            db.execute("CREATE TABLE IF NOT EXISTS pages"
+                       " (path TEXT PRIMARY KEY, mtime INTEGER, size INTEGER, contents TEXT, text BLOB)")
+            self._db = db
+        return self._db
+
+    def get(self, path: Path, mtime: int, size: int) -> Optional[Tuple[str, PageText]]:
+        """ Contents and PageText of the page if stored with the given file mtime and size. """
+        with self._lock:
+            try:
+                row = self._pending.get(path) or self._connect().execute(
+                    "SELECT * FROM pages WHERE path = ?", (str(path),)).fetchone()
+                if row and row[1] == mtime and row[2] == size:
+                    return row[3], PageText.load(row[4])
+            except (sqlite3.Error, ValueError) as err:
+                logger.warning("[Instantsearch] Stored page %s not available: %s", path, err)
+        return None
+
+    def put(self, path: Path, item: "_FileCache"):
+        if self.readonly:
+            return
+        with self._lock:
+            self._pending[path] = (str(path), item.mtime, item.size,
+                                   item.contents, item.text.dump())
+            if len(self._pending) >= self.flush_count:
+                self.flush()
+
+    def remove(self, path: Path):
+        """ The page file does not exist anymore. """
+        if self.readonly:
+            return
+        with self._lock:
+            self._pending.pop(path, None)
+            try:
+                with self._connect() as db:
+                    db.execute("DELETE FROM pages WHERE path = ?", (str(path),))
+            except sqlite3.Error as err:
+                logger.warning("[Instantsearch] Stored page %s not removed: %s", path, err)
+
+    def flush(self):
+        """ Write the pending pages to the disk. """
+        with self._lock:
+            if not self._pending:
+                return
+            try:
+                with self._connect() as db:
+                    db.executemany("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?)", self._pending.values())
+            except sqlite3.Error as err:
+                logger.warning("[Instantsearch] Page cache not stored: %s", err)
+            self._pending.clear()
+
+    def close(self):
+        with self._lock:
+            self.flush()
+            if self._db:
+                self._db.close()
+                self._db = None
+
+    def trim(self, paths: Iterable[Path]):
+        """ Remove the pages whose file does not exist anymore, ex: removed while Zim was not running.
+            :param paths: all the page files of the notebook
+        """
+        if self.readonly:
+            return
+        existing = set(map(str, paths))
+        with self._lock:
+            try:
+                self.flush()
+                removed = [row for row in self._connect().execute("SELECT path FROM pages") if row[0] not in existing]
+                if removed:
+                    with self._connect() as db:
+                        db.executemany("DELETE FROM pages WHERE path = ?", removed)
+            except sqlite3.Error as err:
+                logger.warning("[Instantsearch] Page cache not trimmed: %s", err)
+                return
+        logger.info("[Instantsearch] %d stored pages of the removed files dropped", len(removed))
+
+    def pages(self) -> Generator[Tuple[Path, str, PageText, int, int], None, None]:
+        """ Stored pages (path, contents, text, mtime, size), the most recently stored first. """
+        rows = None
+        while True:
+            with self._lock:  # fetched in batches, the connection is shared with the search
+                try:
+                    if rows is None:
+                        rows = self._connect().execute("SELECT * FROM pages ORDER BY rowid DESC")
+                    batch = rows.fetchmany(self.flush_count)
+                except sqlite3.Error as err:
+                    logger.warning("[Instantsearch] Page cache not available: %s", err)
+                    return
+            if not batch:
+                return
+            for path, mtime, size, contents, text in batch:
+                try:
+                    yield Path(path), contents, PageText.load(text), mtime, size
+                except ValueError as err:
+                    logger.warning("[Instantsearch] Stored page %s not available: %s", path, err)
+
+
+class FileCache:
+    """ Page contents cache, held till the end of Zim process.
+        Every item remembers the file mtime and size so that the pages changed meanwhile are re-read.
+        When the memory limit is reached, the least recently used pages are dropped.
+    """
+    changes_kept = 256  # number of the recent invalidations passed to the worker processes, see sync
+
+    def __init__(self, max_size=100 * 2 ** 20):
+        self.max_size = max_size  # approximate number of bytes held at most
+        self.size = 0
+        self._items: "OrderedDict[Path, _FileCache]" = OrderedDict()
+        # Paths that have already been checked against the disk during the current search dialog.
+        # The dialog is open for a few seconds only, we do not need to stat the files on every keystroke.
+        self._validated: Set[Path] = set()
+        self._lock = RLock()  # used from both the search thread and the main loop
+        # on-disk copies of the cache kept between Zim runs, by the notebook folder, see Engine
+        self.stores: Dict[Path, PageStore] = {}
+        self.stats: Dict[str, float] = Counter()  # cache hits, misses, bytes read..., see Metrics
+        # Every invalidation increments the generation. The worker processes of the parallel search have their own
+        # cache, they are told the recent invalidations with every chunk of pages to search, see sync.
+        self.generation = 0
+        self._changes: List[Optional[Path]] = []  # paths invalidated in the last generations, None for all of them
+
+    def __contains__(self, path: Path):
+        return path in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.invalidate()
+            self.size = 0
+
+    def invalidate(self, path: Optional[Path] = None):
+        """ Pages might change from now on. Keep the contents but check the file mtime before it is used again.
+            :param path: only this page might have changed
+        """
+        with self._lock:
+            if path:
+                self._validated.discard(path)
+            else:
+                self._validated.clear()
+            self.generation += 1
+            self._changes.append(path)
+            del self._changes[:-self.changes_kept]
+
+    def changes(self) -> Tuple[int, List[Optional[Path]]]:
+        """ The current generation and the paths invalidated in the last generations, see sync. """
+        with self._lock:
+            return self.generation, list(self._changes)
+
+    def sync(self, generation: int, changes: List[Optional[Path]]):
+        """ Invalidate the pages invalidated in another process (the main one) since we have synced last time.
+            Ex: a worker process of the parallel search must not serve a page edited since it has read it.
+            :param generation: generation of the other cache
+            :param changes: paths invalidated in its last generations, see changes
+        """
+        with self._lock:
+            if generation == self.generation:
+                return
+            missed = generation - self.generation
+            if 0 < missed <= len(changes) and None not in changes[-missed:]:
+                self._validated.difference_update(changes[-missed:])
+            else:  # we cannot tell which pages have changed
+                self._validated.clear()
+            self.generation = generation
+
+    def discard(self, path: Path):
+        with self._lock:
+            item = self._items.pop(path, None)
+            if item:
+                self.size -= len(item.contents) + item.text.size()
+            self._validated.discard(path)
+
+    def _store(self, path: Path) -> Optional[PageStore]:
+        """ Store of the notebook the page belongs to. """
+        if self.stores:
+            for folder in path.parents:
+                if folder in self.stores:
+                    return self.stores[folder]
+        return None
+
+    def peek(self, path: Path) -> Optional[_FileCache]:
+        """ The page contents if cached, not checked against the disk, ex: the page has just been scored. """
+        return self._items.get(path)
+
+    def get(self, path: Path, path2zim: Callable[[Path], ZimPath]) -> Optional[_FileCache]:
+        """ Returns the page contents (Zim header stripped), re-read from the disk if the file has changed.
+            None if the file cannot be read.
+        """
+        with self._lock:
+            item = self._items.get(path)
+            if item and path in self._validated:
+                self._items.move_to_end(path)
+                self.stats["cache_hits"] += 1
+                return item
+
+            store = self._store(path)
+            try:
+                stat = path.stat()
+            except OSError:  # page has been removed meanwhile
+                self.discard(path)
+                if store:
+                    store.remove(path)
+                return None
+            self._validated.add(path)
+            if item and item.mtime == stat.st_mtime_ns and item.size == stat.st_size:
+                self._items.move_to_end(path)
+                self.stats["cache_hits"] += 1
+                return item
+
+            start = perf_counter()
+            stored = store.get(path, stat.st_mtime_ns, stat.st_size) if store else None
+            if stored:  # read and parsed during a previous Zim run
+                self.discard(path)
+                self.stats["store_hits"] += 1
+                self.stats["store_s"] += perf_counter() - start
+                return self._add(path, _FileCache(path2zim(path), *stored, stat.st_mtime_ns, stat.st_size))
+
+            self.stats["cache_misses"] += 1
+            self.stats["bytes_read"] += stat.st_size
+            try:
+                contents = path.read_text(encoding='UTF-8', errors='replace')
+            except (UnicodeDecodeError, OSError) as err:
+                # Ignore file an skip to next path
+                logger.warning("Skipping path %s due to invalid character encoding error: %s", path, err)
+                self.discard(path)
+                return None
+            # strip header
+            if contents.startswith('Content-Type: text/x-zim-wiki'):
+                # XX will that work on Win?
+                # I should use more general separator IMHO in the whole file rather than '\n'.
+                contents = contents[contents.find("\n\n"):]
+
+            self.discard(path)
+            item = _FileCache(path2zim(path), contents, PageText(contents), stat.st_mtime_ns, stat.st_size)
+            self.stats["read_s"] += perf_counter() - start  # reading and parsing
+            if store:
+                store.put(path, item)
+            return self._add(path, item)
+
+    def _add(self, path: Path, item: _FileCache) -> _FileCache:
+        self._items[path] = item
+        self._validated.add(path)
+        self.size += len(item.contents) + item.text.size()
+        while self.size > self.max_size and self._items:  # drop the least recently used pages
+            self.discard(next(iter(self._items)))
+        return item
+
+    def load(self, store: PageStore, path2zim: Callable[[Path], ZimPath]):
+        """ Fill the cache with the stored pages, till the memory limit. Might run in a thread.
+            Their file mtimes are checked before they are used, as with the pages read during the previous dialog.
+        """
+        start, count = perf_counter(), 0
+        for path, contents, text, mtime, size in store.pages():
+            with self._lock:
+                if path in self._items:  # already read by the search meanwhile
+                    continue
+                if self.size + len(contents) + text.size() > self.max_size:
+                    break
+                # the least recently used ones are dropped first, keep the pages used by the search meanwhile
+                self._items[path] = _FileCache(path2zim(path), contents, text, mtime, size)
+                self._items.move_to_end(path, last=False)
+                self.size += len(contents) + text.size()
+                count += 1
+        logger.info("[Instantsearch] %d stored pages loaded: %g s", count, perf_counter() - start)
+
+
+file_cache = FileCache()
+
+
+def _init_worker(cache_size: int, stores: Dict[Path, Path]):
+    """ Initializes a worker process of the parallel search.
+        :param stores: {notebook folder: page store path}, see FileCache.stores
+    """
+    file_cache.max_size = cache_size
+    for folder, db_path in stores.items():  # the main process writes the store, the workers only read it
+        file_cache.stores[folder] = PageStore(db_path, readonly=True)
+
+
+class TrigramIndex:
+    """ Optional on-disk fulltext index, stored in the notebook cache folder.
+
+        For every page file, we store the set of trigrams of its normalized text (see PageText).
+        Before the page contents are searched, the pages that cannot contain all the query terms are skipped.
+        The index is updated from the file mtimes.
+    """
+    commit_interval = 256  # number of the pages re-indexed in a transaction
+
+    def __init__(self, db_path: Path):
+        self.db_path = db_path
+        self._db: Optional[sqlite3.Connection] = None
+        self._files: Dict[Path, _IndexedFile] = {}
+        self._validated: Set[Path] = set()  # paths whose mtime has been checked during the current dialog session
+        # The database lock is held for a page at once while re-indexing. The main loop invalidates the pages
+        # while the search thread re-indexes them, it takes the small lock only and does not wait for the re-index.
+        self._lock = RLock()
+        self._validated_lock = RLock()
+
+    @classmethod
+    def trigrams(cls, text: str) -> Set[str]:
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    @classmethod
+    def page_trigrams(cls, text: PageText) -> Set[str]:
+        # trigrams across the line breaks are useless but harmless
+        return cls.trigrams(text.body) | cls.trigrams(text.links)
+
+    def _connect(self) -> sqlite3.Connection:
+        if not self._db:
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(str(self.db_path), check_same_thread=False)
+            db.executescript("""
+                CREATE TABLE IF NOT EXISTS files
+                    (id INTEGER PRIMARY KEY, path TEXT UNIQUE, name TEXT, mtime INTEGER, size INTEGER);
+                CREATE TABLE IF NOT EXISTS trigrams
+                    (trigram TEXT, file INTEGER, PRIMARY KEY (trigram, file)) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS trigrams_file ON trigrams (file);
+            """)
+            self._files = {Path(path): _IndexedFile(id_, name, mtime, size)
+                           for id_, path, name, mtime, size in db.execute("SELECT * FROM files")}
+            self._db = db
+        return self._db
+
+    def invalidate(self, path: Optional[Path] = None):
+        """ Pages might change from now on, check the file mtimes again before the index is used.
+            :param path: only this page might have changed
+        """
+        with self._validated_lock:
+            if path:
+                self._validated.discard(path)
+            else:
+                self._validated.clear()
+
+    def _remove(self, db, path: Path):
+        item = self._files.pop(path, None)
+        if item:
+            db.execute("DELETE FROM trigrams WHERE file = ?", (item.id,))
+            db.execute("DELETE FROM files WHERE id = ?", (item.id,))
+
+    def update(self, paths: List[Path], path2zim: Callable[[Path], ZimPath], complete=False):
+        """ Re-index the pages changed since the last time.
+            :param complete: paths are all the notebook files, forget any other indexed file
+        """
+        with self._lock:
+            db = self._connect()
+            if complete:
+                with db:
+                    [self._remove(db, path) for path in set(self._files).difference(paths)]
+        changed = 0
+        try:
+            for path in paths:
+                with self._validated_lock:
+                    if path in self._validated:
+                        continue
+                    self._validated.add(path)
+                item = self._files.get(path)
+                try:
+                    stat = path.stat()
+                except OSError:
+                    if item:
+                        with self._lock:
+                            self._remove(db, path)
+                    continue
+                if item and item.mtime == stat.st_mtime_ns and item.size == stat.st_size:
+                    continue
+                cached = file_cache.get(path, path2zim)  # read without holding the lock
+                if not cached:
+                    continue
+                with self._lock:
+                    self._remove(db, path)
+                    # the mtime is the one the contents were read at
+                    id_ = db.execute("INSERT INTO files (path, name, mtime, size) VALUES (?, ?, ?, ?)",
+                                     (str(path), str(cached.path).casefold(), cached.mtime, cached.size)).lastrowid
+                    db.executemany("INSERT INTO trigrams VALUES (?, ?)",
+                                   ((t, id_) for t in self.page_trigrams(cached.text)))
+                    self._files[path] = _IndexedFile(id_, str(cached.path).casefold(), cached.mtime, cached.size)
+                    changed += 1
+                    if not changed % self.commit_interval:
+                        db.commit()
+        except BaseException:
+            with self._lock:  # the pages of the transaction are not indexed, read the index again next time
+                db.rollback()
+                db.close()
+                self._db = None
+                self.invalidate()
+            raise
+        with self._lock:
+            db.commit()
+
+    def filter(self, paths: List[Path], query: str) -> List[Path]:
+        """ Returns the paths that might match the external search. Every query term must be either
+            in the page name or all of its trigrams must be in the page contents. """
+        with self._lock:
+            db = self._connect()
+            ids = None
+            for q in query.split(" "):
+                q_trigrams = self.trigrams(PageText.markup.sub("", q.lower()))
+                if not q_trigrams:  # too short term cannot narrow the search
+                    continue
+                found = {id_ for id_, in db.execute(f"SELECT file FROM trigrams WHERE trigram IN"
+                                                     f" ({','.join('?' * len(q_trigrams))})"
+                                                     f" GROUP BY file HAVING COUNT(*) = ?",
+                                                     (*q_trigrams, len(q_trigrams)))}
+                found.update(item.id for item in self._files.values() if q in item.name)
+                ids = found if ids is None else ids & found
+            if ids is None:
+                return paths
+            # files not indexed (unreadable) are kept, the external search deals with them
+            return [p for p in paths if p not in self._files or self._files[p].id in ids]
+
+
+class _IndexedFile(NamedTuple):
+    id: int
+    name: str  # casefolded page name
+    mtime: int
+    size: int
+
+
+class _Folder(NamedTuple):
+    mtime: int  # st_mtime_ns of the folder when read, changes when a file is added, removed or renamed there
+    files: List[Path]  # page files
+    folders: List[str]  # sub-folders
+
+
+class Manifest:
+    """ Page files of the notebook, walked by os.scandir.
+
+        The entries of every folder are kept with the folder mtime so that only the folders changed since
+        are read again; the others take a single stat. The DirEntry type info spares a stat of every file.
+        The page of every file is cached as well so that the notebook layout is not asked on every search.
+        The hidden folders are skipped, see hidden.
+    """
+    racy_time = 2  # seconds, some file systems have the folder mtime that coarse
+
+    def __init__(self, folder: Path, extension: str, path2zim: Callable[[Path], ZimPath]):
+        self.folder = folder
+        self.extension = normcase(extension)
+        self.path2zim = path2zim
+        self._folders: Dict[str, _Folder] = {}
+        self._pages: Dict[Path, ZimPath] = {}
+        self._lock = RLock()  # used from both the search thread and the main loop
+
+    @staticmethod
+    def hidden(name: str) -> bool:
+        """ Zim does not list the pages in the hidden folders, ex: the ".zim" cache folder, we neither search them
+            nor watch them for changes.
+        """
+        return name.startswith(".")
+
+    def paths(self) -> List[Path]:
+        """ All the page files of the notebook, the same ones as Path.rglob would give, except the hidden folders. """
+        with self._lock:
+            paths: List[Path] = []
+            seen: Set[str] = set()
+            self._walk(str(self.folder), paths, seen)
+            for folder in set(self._folders).difference(seen):  # removed folders
+                self._forget(self._folders.pop(folder).files)
+            return paths
+
+    def folders(self) -> List[Path]:
+        """ The notebook folders met by the last walk, see paths. """
+        with self._lock:
+            return [Path(folder) for folder in self._folders]
+
+    def page(self, path: Path) -> ZimPath:
+        """ Page of the file. """
+        page = self._pages.get(path)
+        if page is None:
+            page = self._pages[path] = self.path2zim(path)
+        return page
+
+    def _forget(self, files: Iterable[Path]):
+        for path in files:
+            self._pages.pop(path, None)
+
+    def _walk(self, folder: str, paths: List[Path], seen: Set[str]):
+        seen.add(folder)
+        try:
+            mtime = os.stat(folder).st_mtime_ns
+        except OSError:  # removed meanwhile
+            return
+        cached = self._folders.get(folder)
+        if not cached or cached.mtime != mtime:
+            files, folders = [], []
+            try:
+                with os.scandir(folder) as entries:
+                    for entry in entries:
+                        # as rglob does, the symlinked folders are not followed, the symlinked files are
+                        if entry.is_dir(follow_symlinks=False):
+                            if not self.hidden(entry.name):
+                                folders.append(entry.path)
+                        elif normcase(entry.name).endswith(self.extension) and entry.is_file():
+                            files.append(Path(entry.path))
+            except OSError as err:
+                logger.warning("[Instantsearch] Skipping folder %s: %s", folder, err)
+            if cached:
+                self._forget(set(cached.files).difference(files))
+            if time() - mtime / 1e9 < self.racy_time:
+                mtime = -1  # a file added in the same mtime tick would be missed, read the folder again next time
+            cached = self._folders[folder] = _Folder(mtime, files, folders)
+        paths.extend(cached.files)
+        for sub_folder in cached.folders:
+            self._walk(sub_folder, paths, seen)
+
+
+class Scan:
+    """ A single run of the fulltext search. It gets cancelled when the user types another query. """
+    check_interval = 16  # number of pages scanned between the cancellation checks
+
+    def __init__(self):
+        self.cancelled = False
+        self.matching_files: List[Path] = []
+        # where the query terms were found in the matching pages, see SearchController.fulltext_score
+        self.offsets: Dict[Path, array] = {}
+        self.snippets: Dict[ZimPathStr, str] = {}  # context of the best match, see SearchController.snippet
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Metrics(Counter):
+    """ Timings (in seconds, the keys ending with "_s") and counters of the phases of a search, see State.metrics.
+
+        The code running in the search thread and in the worker processes counts into the global counters,
+        FileCache.stats and SearchController.stats, a search takes their difference. The numbers are approximate,
+        ex: the preview read meanwhile counts into the search running.
+    """
+
+    @contextmanager
+    def timer(self, phase: str):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self[phase + "_s"] += perf_counter() - start
+
+    @staticmethod
+    def snapshot() -> Counter:
+        """ The global counters now. """
+        return file_cache.stats + SearchController.stats
+
+    def add_since(self, snapshot: Counter):
+        """ Count in what the global counters got since the snapshot. """
+        self.update(Metrics.snapshot() - snapshot)
+
+    def as_dict(self) -> Dict[str, float]:
+        """ Timings in ms, rounded. """
+        return {key[:-2] + "_ms" if key.endswith("_s") else key: round(value * 1000, 3) if key.endswith("_s") else value
+                for key, value in sorted(self.items())}
+
+    def format(self) -> str:
+        return "\n".join(f"{key}: {value:g}" for key, value in self.as_dict().items())
+
+
+class StateCache:
+    """ Search results of the queries typed into the notebook, see State. Every Engine (notebook) has its own.
+
+        The cache is held till the end of zim process or till the pages change.
+        It is bounded, the least recently used states are dropped, except for the prefixes of the current query.
+    """
+    max_states = 100
+    max_size = 50 * 2 ** 20  # approximate number of bytes
+
+    def __init__(self):
+        self._states: "OrderedDict[str, State]" = OrderedDict()
+        self._current: Optional["State"] = None
+        self.stats: Dict[str, int] = Counter()  # debug counter: hits, misses, evictions, invalidations
+
+    def __iter__(self):
+        """ The cached queries, the least recently used first. """
+        return iter(self._states)
+
+    def reset(self):
+        """ Reset the cache. (That is normally held till the end of Zim.) """
+        self._states = OrderedDict()
+
+    def invalidate(self, affected: Optional[Callable[["State"], bool]] = None):
+        """ Pages have changed, cached search results are no longer valid.
+            :param affected: only the states whose results might have changed are dropped
+        """
+        if not affected:
+            if self._states:
+                self.stats["invalidations"] += 1
+                self.reset()
+                self._current = None
+            return
+        for query, state in list(self._states.items()):
+            if affected(state):
+                self.stats["invalidations"] += 1
+                self._drop(query)
+                if state is self._current:
+                    self._current = None
+
+    def _drop(self, query: str):
+        state = self._states.pop(query)
+        for other in self._states.values():  # do not keep the dropped state in the memory
+            if other.previous is state:
+                other.previous = None
+
+    def _evict(self):
+        """ Drop the least recently used states if the cache is too big. """
+        protected = set()  # prefix chain of the current query, needed to narrow the search
+        state = self._current
+        while state:
+            protected.add(state)
+            state = state.previous
+
+        size = sum(state.size() for state in self._states.values())
+        for query, state in list(self._states.items()):
+            if len(self._states) <= self.max_states and size <= self.max_size:
+                break
+            if state in protected:
+                continue
+            self._drop(query)
+            size -= state.size()
+            self.stats["evictions"] += 1
+        logger.debug("[Instantsearch] State cache: %d states, %d B, %s", len(self._states), size, dict(self.stats))
+
+    def set_current(self, raw_query) -> "State":
+        """ Returns other state.
+            raw_query may include '!' sign for title only search
+        """
+        raw_query = r = raw_query.lower()
+        if self._current and self._current.raw_query != raw_query and self._current.scan:
+            self._current.scan.cancel()  # the current search is superseded by the new query
+        if raw_query not in self._states:
+            self.stats["misses"] += 1
+            # we are subset of this state from the longest shorter query
+            previous = next((self._states[r[:i]] for i in range(len(r), 0, -1) if r[:i] in self._states), None)
+            self._states[raw_query] = self._current = State(raw_query, previous)
+            self._evict()
+        else:
+            self.stats["hits"] += 1
+            self._states.move_to_end(raw_query)
+            self._states[raw_query].first_seen = False
+            self._current = self._states[raw_query]
+        return self._current
+
+    def get(self, query) -> "State":
+        return self._states[query.lower()]
+
+
+class State:
+    matching_files: Optional[List[Path]]  # None if state search has not been started
+    unscanned: Optional[List[Path]]  # paths not scanned when the search was cancelled
+    scan: Optional[Scan]  # the last fulltext search run
+    results_shown = 50  # number of the results shown at once, more are shown when the caret gets past them
+    previous: Optional["State"]
+    title_match_char = "!"  # see the plugin preferences
+    start_search_length = 3
+    page_name_only: bool
+
+    def __init__(self, raw_query, previous: Optional["State"] = None):
+        """ :param previous: state of the longest shorter query, this state narrows its results """
+        self.items: List[_MenuItem] = []  # the best results, sorted
+        self.count = 0  # number of all the results
+        self.limit = State.results_shown  # number of the items at most
+        self.is_finished = False
+        self.matching_files = self.unscanned = self.scan = None
+        self.raw_query = raw_query  # including '!' sign for title only search
+        self.first_seen = True
+        self.metrics = Metrics()
+        self.previous = previous
+
+        # since having <= 3 letters uses less benevolent searching method, we cannot reduce the next step
+        # ex: "!est" should not match "testing" but "!esti" should
+        if self.previous and self.previous.page_name_only:
+            self.previous = None
+
+        self.menu = self._derived_menu()
+
+        # check if we query page titles only, based on the special '!' sign in the query text
+        # first char is "!" -> searches in page name only
+        self.page_name_only, self.query = (True, raw_query[len(State.title_match_char):].lower()) \
+            if raw_query.startswith(State.title_match_char) \
+            else (False, raw_query)
+        if len(self.query) < State.start_search_length:
+            self.page_name_only = True  # search only in page names, not in page contents
+
+    @property
+    def candidate_paths(self) -> Optional[List[Path]]:
+        """ Paths a narrower query has to search through, None if not known. """
+        if self.is_finished:
+            return self.matching_files
+        if self.unscanned is not None and self.matching_files is not None:
+            # the search has been cancelled, we take both matching and not yet scanned paths
+            return self.matching_files + self.unscanned
+        return None
+
+    def size(self) -> int:
+        """ Approximate number of bytes taken. """
+        offsets = sum(map(len, self.scan.offsets.values())) if self.scan else 0
+        snippets = 100 * len(self.scan.snippets) if self.scan else 0
+        paths = len(self.matching_files or ()) + len(self.unscanned or ())
+        return 300 * len(self.menu) + 8 * (len(self.items) + paths) + 4 * offsets + snippets
+
+    def match_offsets(self, path: Path) -> Optional[array]:
+        """ Where the fulltext search found the query terms in the page, None if not recorded. """
+        return self.scan.offsets.get(path) if self.scan else None
+
+    def snippet(self, page: ZimPathStr) -> str:
+        """ Context of the best match of the query in the page contents, empty if not known. """
+        return self.scan.snippets.get(page, "") if self.scan else ""
+
+    def _derived_menu(self) -> "Menu":
+        """ Copy of the previous state items narrowed down by this state. Their scores will be re-counted. """
+        menu: Menu = defaultdict(_MenuItem)
+        if self.previous:
+            menu.update((path, item.derive()) for path, item in self.previous.menu.items())
+        return menu
+
+    def restart(self):
+        """ The state is searched again, ex: its scan has been cancelled or it searches the page names only.
+            The scores are counted from scratch, the title search would add its scores to the menu twice.
+        """
+        self.menu = self._derived_menu()
+        self.items = []
+
+    def new_scan(self) -> Scan:
+        """ Start the fulltext search again, cancel the running one. """
+        if self.scan:
+            self.scan.cancel()
+        self.matching_files = self.unscanned = None
+        self.scan = Scan()
+        return self.scan
+
+    def scan_cancelled(self, scan: Scan, unscanned: List[Path]):
+        """ Record partial search results. Called from the search thread. """
+        if scan is self.scan:
+            self.unscanned = unscanned
+            self.matching_files = scan.matching_files
+
+    def scan_finished(self, scan: Scan):
+        if scan is self.scan:
+            self.matching_files = scan.matching_files
+            self.is_finished = True
+
+    def add_scores(self, scores: Dict[ZimPathStr, int]) -> bool:
+        """ Put the page contents scores into the menu. Returns True if a page has been added. """
+        changed = False
+        for path, score in scores.items():
+            if path not in self.menu or (self.menu[path].page_score < 0 and self.menu[path].score == 0):
+                changed = True
+            o: _MenuItem = self.menu[path]
+            o.score = score  # includes into options
+            o.path = path
+        return changed
+
+    def sort_items(self, sort=True, limit: Optional[int] = None):
+        """ Sort the best menu items into the items, at most self.limit of them. """
+        # Items appear only if they have score either from the page contents or the page name search.
+        # And if the score comes from the page name search only, page_insufficient must be True
+        # (at least one term appears in the least subpage name).
+        # Note: I do not know why there are items with score 0 if internal Zim search used
+        start = perf_counter()
+        eligible = [page for page in self.menu.values() if
+                    (page.score or not page.page_insufficient)
+                    and (page.score + page.page_score) > 0]
+        self.count = len(eligible)
+
+        if sort:
+            def key(item):
+                return item.page_highlight, item.score + item.page_score, -item.path.count(":"), item.path
+        else:
+            # when search results are being updated, it's good when the order does not change all the time.
+            # So that the first result does not become for a while 10th and then become first back.
+            def key(item):
+                return item.page_highlight, -item.last_order
+
+        # a query may match thousands of pages, selecting the few shown is cheaper than sorting them all
+        self.items = nlargest(limit or self.limit, eligible, key=key)
+        self.metrics["sort_s"] += perf_counter() - start
+
+    @property
+    def hidden(self) -> int:
+        """ Number of the results not among the items. """
+        return self.count - len(self.items)
+
+    def show_more(self, at_least=0):
+        """ Let the next page of the results be among the items. """
+        self.limit = max(self.limit + State.results_shown, at_least)
+        self.sort_items()
+
+
+class _MenuItem:
+    __slots__ = "path", "score", "page_score", "page_highlight", "last_order", "page_insufficient"
+
+    def __init__(self):
+        self.path: Optional[ZimPathStr] = None
+        self.score = 0  # score given by SearchSelection (page contents search)
+        self.page_score = 0  # score from the page name search
+        self.page_highlight = False  # page name search priority match (query term is not in the middle of the word)
+        self.last_order = 0
+
+        # None of the query terms is in the least subpage name. Such results may appear only
+        # if some of the term is found in the page context too. But the page search is insufficient.
+        self.page_insufficient = False
+
+    def derive(self) -> "_MenuItem":
+        """ Copy of the item for a state that narrows down the search. However, score will be re-counted. """
+        item = _MenuItem()
+        item.path = self.path
+        item.last_order = self.last_order
+        item.page_insufficient = self.page_insufficient
+        return item
+
+
+
+Menu = DefaultDict[ZimPathStr, _MenuItem]  # search results: page name -> item
+
+
+class QueryPlan:
+    """ Everything the search derives from the query string: the terms and the compiled regexes
+        of the title search, of the fulltext search and of the preview highlighting.
+
+        Built once per distinct query, see QueryPlan.get. The regexes of each of the three are compiled
+        the first time they are needed, ex: the worker processes of the parallel search need the fulltext ones only.
+    """
+
+    def __init__(self, query: str):
+        self.query = query
+        self.terms = query.split(" ")  # independent words "foo economical" -> "foo", "economical", both must match
+        # the terms might be searched for in the text normalized beforehand, see PageText
+        self.plain = all(self.terms) and not PageText.markup.search(query)
+        self._title = self._candidates = self._fulltext = self._preview = None
+
+    @staticmethod
+    @lru_cache(maxsize=128)
+    def get(query: str) -> "QueryPlan":
+        return QueryPlan(query)
+
+    def title_regexes(self) -> Tuple[List[Pattern], List[Pattern]]:
+        """ Regexes of the page title search. Note that the terms are treated as regex patterns. """
+        if self._title is None:
+            # 'te' matches these page titles: 'test' or 'Journal:test' or 'foo test' or 'foo (test)'
+            sub_queries_benevolent = [re.compile(r"(^|:|\s|\()?" + q, re.IGNORECASE) for q in self.terms]
+            # 'st' does not match those
+            sub_queries_strict = [re.compile(r"(^|:|\s|\()" + q, re.IGNORECASE) for q in self.terms]
+            self._title = sub_queries_benevolent, sub_queries_strict
+        return self._title
+
+    def title_candidates(self) -> Tuple[Optional[str], Optional[Pattern]]:
+        """ Term searched for in the title cache haystack, and the regex if the term must be at a title part beginning.
+            None if the terms cannot narrow the title search, see TitleCache.candidates.
+        """
+        if self._candidates is None:
+            # the terms treated as regex patterns in the header search or having special case folding cannot help
+            terms = [q for q in self.terms if q and all(ord(c) < 128 for c in q) and re.escape(q) == q]
+            if not terms:
+                self._candidates = None, None
+            else:
+                q = max(terms, key=len)  # every term has to match, searching for the longest one narrows the most
+                # strict search, the term must be at a title part beginning
+                self._candidates = q, re.compile(r"(?:^|[:\s(])" + q) if len(self.query) <= 3 else None
+        return self._candidates
+
+    def fulltext_regexes(self) -> Tuple[List[Tuple[str, Pattern]], Optional[Pattern], List[Pattern]]:
+        """ Regexes of the fulltext search, used if the query is not plain. """
+        if self._fulltext is None:
+            # strip markup: **bold**, //italic//,  __underline__, ''verbatim'', ~~strike through~~
+            # matches query "economi**cal**"
+
+            def letter_split(q):
+                """ Every letter is divided by a any-formatting-match-group and escaped.
+                    'foo.' -> 'f[*/'_~]o[*/'_~]o[*/'_~]\\.'
+                """
+                return r"[*/'_~]*".join((re.escape(c) for c in list(q)))
+
+            # regex to identify in all sub_queries present in the text
+            queries = [(q, re.compile(letter_split(q), re.IGNORECASE)) for q in self.terms]
+
+            # regex to identify the very query is present
+            exact_query = re.compile(letter_split(self.query), re.IGNORECASE) if len(self.terms) > 1 else None
+
+            # regex to count the number of the sub_queries present and to optionally add information about header used
+            header_queries = [re.compile("(\n=+ .*)?" + letter_split(q), re.IGNORECASE) for q in self.terms]
+
+            self._fulltext = queries, exact_query, header_queries
+        return self._fulltext
+
+    def preview_regexes(self) -> Tuple[List[Pattern], List[Pattern]]:
+        """ Regexes highlighting the terms in the preview and extracting them from the long lines. """
+        if self._preview is None:
+            # searching for "a" cannot match "&a", since markup_escape_text("&") -> "&apos;"
+            # Ignoring q == "b", it would interfere with multiple queries:
+            # Ex: query "f b", text "foo", matched with "f" -> "<b>f</b>oo",
+            #   matched with "b" -> "<<b>b</b>>f</<b>b</b>>"
+            query_match = [re.compile("(" + re.escape(q) + ")", re.IGNORECASE) for q in self.terms if q != "b"]
+            # too long lines caused strange Gtk behaviour – monitor brightness set to maximum,
+            # without any logged warning so that I decided to put just extract of such long lines in preview
+            # This regex matches query chunk in the line, prepends characters before and after.
+            # When there should be the same query chunk after the first, it stops.
+            # Otherwise, the second chunk might be halved and thus not highlighted.
+            # Ex: query "test", text: "lorem ipsum text dolor text text sit amet consectetur" ->
+            #   ["ipsum text dolor ", "text ", "text sit amet"] (words "lorem" and "consectetur" are strip)
+            line_extract = [re.compile("(.{0,80}" + re.escape(q) + "(?:(?!" + re.escape(q) + ").){0,80})",
+                                       re.IGNORECASE) for q in self.terms if q != "b"]
+            self._preview = query_match, line_extract
+        return self._preview
+
+
+class TitleCache:
+    """ Sorted page titles of the notebook. Built once, then updated when the notebook index changes.
+
+        To find the titles that might match the query, all the casefolded titles are joined to a single string
+        which is searched through at once, instead of running the regexes on every title.
+    """
+
+    def __init__(self):
+        self.titles: List[ZimPathStr] = []
+        self.is_built = False
+        self.build_s = 0.0  # time the build took
+        self._haystack: Optional[str] = None  # casefolded titles joined by a new line, built lazily
+        self._starts = array("l")  # haystack index of every title
+
+    @property
+    def haystack(self) -> str:
+        if self._haystack is None:
+            # re.IGNORECASE matches 'i' with the dotless 'ı', keep the haystack a superset
+            folded = [t.casefold().replace("ı", "i") for t in self.titles]
+            self._starts = array("l", [0] if folded else []) + array("l", accumulate(len(t) + 1 for t in folded[:-1]))
+            self._haystack = "\n".join(folded)
+        return self._haystack
+
+    def candidates(self, query: str) -> List[ZimPathStr]:
+        """ Titles that might match SearchController.header_search, a superset of them. """
+        q, strict = QueryPlan.get(query).title_candidates()
+        if not q:
+            return self.titles
+        haystack = self.haystack
+        if strict:  # the term must be at a title part beginning
+            def find(pos):
+                m = strict.search(haystack, max(pos - 1, 0))  # include the new line before the title
+                return m.end() - len(q) if m else -1
+        else:
+            def find(pos):
+                return haystack.find(q, pos)
+
+        result = []
+        pos = 0
+        while True:
+            found = find(pos)
+            if found == -1:
+                return result
+            i = bisect_right(self._starts, found) - 1
+            result.append(self.titles[i])
+            if i + 1 == len(self._starts):
+                return result
+            pos = self._starts[i + 1]  # continue with the next title
+
+    def build(self, titles: Iterable[ZimPathStr]):
+        """ Quick title cache, built from the notebook index. """
+        start = perf_counter()
+        self.titles = sorted(set(self.titles).union(titles))  # the index might have inserted some pages already
+        self.build_s = perf_counter() - start
+        self.is_built = True
+        self._haystack = None
+
+    def add(self, title: ZimPathStr):
+        i = bisect_left(self.titles, title)
+        if title and (i == len(self.titles) or self.titles[i] != title):
+            self.titles.insert(i, title)
+            self._haystack = None
+
+    def remove(self, title: ZimPathStr):
+        i = bisect_left(self.titles, title)
+        if i < len(self.titles) and self.titles[i] == title:
+            del self.titles[i]
+            self._haystack = None
+
+
+class SearchController:
+    stream_size = 2 ** 20  # bigger files are streamed before they are read whole (0 to disable)
+    stream_chunk = 2 ** 16  # number of characters read at once when streaming
+    max_offsets = 256  # number of the match offsets recorded per page, the preview does not show more lines
+    snippet_length = 80  # number of characters of the page contents shown in the result list
+    stats: Dict[str, float] = Counter()  # time spent scoring the pages..., see Metrics
+
+    @staticmethod
+    def fulltext_score(query: str, page_name: str, page: _FileCache,
+                       offsets: Optional[array] = None) -> Optional[Tuple[int, bool]]:
+        """ Score the page contents.
+            :param offsets: If the page matches, the sorted normalized indices (see PageText) of the query terms
+                found while scoring are put into it, at most max_offsets of them. So that the preview does not
+                have to search the page again. Left empty if not known, ex: the query is not plain.
+            :return: None if the page does not match,
+                (score, True) if the page matches,
+                (0, False) if the page should be kept for the next narrower query although it does not match now.
+        """
+        plan = QueryPlan.get(query)
+        sub_queries = plan.terms
+
+        if plan.plain:
+            # plain search in the text normalized beforehand
+            text = page.text
+
+            def found_term(q):
+                return q in text.body or q in text.links
+
+            def count_score():
+                # the terms found in the links only cannot be located in the contents, we do not record them
+                found = offsets if offsets is not None and not any(q in text.links for q in sub_queries) else None
+                score = sum(text.score(q, found) for q in sub_queries)
+                if found:
+                    if len(sub_queries) > 1:
+                        found[:] = array(found.typecode, sorted(found))
+                    del found[SearchController.max_offsets:]
+                if len(sub_queries) > 1:  # there are sub-queries, we favourize full-match
+                    score += 100 * text.body.count(query)
+                return score
+        else:
+            # An empty term (ex: a trailing space) or a term containing markup characters
+            # cannot be searched for in the normalized text, we use the regexes.
+            queries, exact_query, header_queries = plan.fulltext_regexes()
+            regexes = dict(queries)
+            matched_links = []
+
+            def matched_link(match):
+                matched_links.append(match.group(1))
+                return ""
+
+            # pull out links "economi[[inserted link]]cal" -> "economical" + "inserted link"
+            txt_body = link.sub(matched_link, page.contents)
+            txt_links = "".join(matched_links)
+
+            def found_term(q):
+                return regexes[q].search(txt_body) or regexes[q].search(txt_links)
+
+            def count_score():
+                # score = header order * 3 + body match count * 1
+                # if there are '=' equal chars before the query, it is header. The bigger number, the bigger header.
+                # Header 5 corresponds to 3 points, Header 1 to 7 points. XX it seems Header 5 ~ 3 points, Header 1 ~ 15 points. Might be more IMHO, like * 5 instead of * 3.
+                score = sum([len(m.group(1)) * 3 if m.group(1) else 1
+                             for q in header_queries for m in q.finditer(txt_body)])
+                if exact_query:  # there are sub-queries, we favourize full-match
+                    score += 100 * len(exact_query.findall(txt_body))
+                return score
+
+        # wanted terms do not occur in the page name, waiting to be found in the page contents
+        wanted = [q for q in sub_queries if q not in page_name.casefold()]
+
+        def found(it):  # whether sub queries are found in the text
+            return (found_term(q) for q in it)
+
+        # Process, if not all query-terms (pieces, words, bits) are found in the page name
+        # and thus the page would be ignored, but all of the remaining terms are found withing the page contents.
+        # Or if all the terms are included in the page name (anywhere in the page name,
+        # it does not have to be in its final part, in the least subpage), process if any of the terms are found
+        # within the page contents as a bonus.
+        if wanted and all(found(wanted)) or not wanted and any(found(sub_queries)):
+            # score might be zero because we are not re-checking against txt_links matches
+            return count_score() or 1, True
+        elif not wanted:
+            # The page is not eligible for fulltext search now. However, a term (part of the query) may appear
+            # that will render the page thrown up from the page name search alone
+            # but is included in the page contents.
+            # Use case:
+            # Step 1: Query "linux foo" matches page "Linux:foo" while neither term is in the page contents ('bar').
+            # Step 2: Query "linux foo b" matches page "Linux:foo" because 'bar' is in the page contents.
+            return 0, False
+        return None
+
+    @staticmethod
+    def file_score(query: str, path: Path, path2zim: Callable[[Path], ZimPath],
+                   offsets: Optional[array] = None) -> Optional[Tuple[ZimPath, int, bool]]:
+        """ Score the page file, see fulltext_score.
+            A big file that is not cached is streamed first and read whole only if it might match.
+        """
+        plan = QueryPlan.get(query)
+        sub_queries = plan.terms
+        if SearchController.stream_size and path not in file_cache and plan.plain:
+            try:
+                size = path.stat().st_size
+            except OSError:  # page has been removed meanwhile
+                return None
+            if size > SearchController.stream_size:
+                zim_path = path2zim(path)
+                wanted = [q for q in sub_queries if q not in str(zim_path).casefold()]
+                start = perf_counter()
+                found = SearchController.stream_found(path, wanted or sub_queries, every=bool(wanted))
+                SearchController.stats["stream_s"] += perf_counter() - start
+                SearchController.stats["streamed"] += 1
+                if not found:
+                    return None if wanted else (zim_path, 0, False)
+
+        cached = file_cache.get(path, path2zim)
+        start = perf_counter()
+        result = cached and SearchController.fulltext_score(query, str(cached.path), cached, offsets)
+        # finding and scoring the terms in the normalized text, or by the regexes if the query is not plain
+        SearchController.stats["score_s" if plan.plain else "regex_s"] += perf_counter() - start
+        return (cached.path, *result) if result else None
+
+    @staticmethod
+    def stream_found(path: Path, terms: List[str], every: bool) -> bool:
+        """ Whether every (or any) of the terms might be found in the page, as PageText would find them.
+            The file is read in chunks, we stop as soon as the terms are found.
+            If the file cannot be read, True is returned, let the caller deal with it.
+        """
+        missing = set(terms)
+        links_tail = ""  # the terms might be found in the links text joined together
+        tail_size = max(map(len, terms)) - 1
+        try:
+            with path.open(encoding='UTF-8', errors='replace') as f:
+                rest = ""  # unfinished line
+                while missing:
+                    chunk = f.read(SearchController.stream_chunk)
+                    if chunk:
+                        # cut the chunk at the line end, neither the links nor the terms span over lines
+                        end = chunk.rfind("\n") + 1
+                        if not end:  # a very long line
+                            rest += chunk
+                            continue
+                        block, rest = rest + chunk[:end], chunk[end:]
+                    elif rest:
+                        block, rest = rest, ""
+                    else:
+                        break
+                    links = links_tail + PageText.markup.sub("", "".join(link.findall(block)).lower())
+                    body = PageText.markup.sub("", link.sub("", block)).lower()
+                    found = {q for q in missing if q in body or q in links}
+                    if found and not every:
+                        return True
+                    missing -= found
+                    links_tail = links[-tail_size:] if tail_size else ""
+        except (UnicodeDecodeError, OSError):
+            return True
+        return not missing
+
+    @staticmethod
+    def snippet(query: str, page: _FileCache, offsets: array) -> str:
+        """ Single line of the page contents around the best of the query terms found, see fulltext_score.
+            The whole query is better than a single term, a term in the page text better than in its title line.
+        """
+        if not offsets:
+            return ""
+        body, whole = page.text.body, " " in query
+        title_end = body.find("\n", len(body) - len(body.lstrip("\n")))  # the first line is the page title
+        best = max(islice(offsets, 64),
+                   key=lambda i: (whole and body.startswith(query, i), title_end != -1 and i > title_end))
+
+        contents, length = page.contents, SearchController.snippet_length
+        pos = page.text.offset(best)
+        line_start = contents.rfind("\n", 0, pos) + 1
+        line_end = contents.find("\n", pos)
+        if line_end == -1:
+            line_end = len(contents)
+        start = max(line_start, pos - length // 3)  # some words before the match
+        end = min(line_end, start + length)
+        start = max(line_start, end - length)  # the line ends soon, take more words before
+        text, match = contents[start:end], pos - start
+        if end < line_end and not contents[end].isspace():  # do not end with a part of a word
+            cut = text.rfind(" ", match + len(query))
+            text = text[:cut] if cut != -1 else text
+        if start > line_start and not contents[start - 1].isspace():  # nor start with it
+            text = text[text.find(" ", 0, match) + 1:]
+        return ("…" if start > line_start else "") + " ".join(text.split()) + ("…" if end < line_end else "")
+
+    @staticmethod
+    def file_snippet(query: str, path: Path, offsets: array) -> str:
+        """ Snippet of the page file just scored, see snippet. """
+        start = perf_counter()
+        cached = offsets and file_cache.peek(path)
+        snippet = SearchController.snippet(query, cached, offsets) if cached else ""
+        SearchController.stats["snippet_s"] += perf_counter() - start
+        return snippet
+
+    @staticmethod
+    def fulltext_chunk(query: str, pages: List[Tuple[Path, str]], snippets=True,
+                       changes: Tuple[int, List[Optional[Path]]] = (0, [])
+                       ) -> Tuple[List[Tuple[Path, int, bool, array, str]], Counter]:
+        """ Runs in a worker process of the parallel search. Scores the given pages (file path, page name).
+            Every worker process has its own page contents cache, kept till the pool is shut down.
+            Returns the results and what the worker has counted meanwhile, see Metrics.
+            :param changes: invalidations of the main process cache, see FileCache.changes
+        """
+        file_cache.sync(*changes)
+        snapshot = Metrics.snapshot()
+        results = []
+        for path, page_name in pages:
+            offsets = array("i")
+            result = SearchController.file_score(query, path, lambda _: page_name, offsets)
+            if result:
+                snippet = SearchController.file_snippet(query, path, offsets) \
+                    if snippets and result[2] else ""
+                results.append((path, *result[1:], offsets, snippet))
+        return results, Metrics.snapshot() - snapshot
+
+    @staticmethod
+    def header_search(query: str, menu: Menu, cached_titles: Union[List[ZimPathStr], TitleCache]) -> None:
+        sub_queries_benevolent, sub_queries_strict = QueryPlan.get(query).title_regexes()
+
+        def in_query(txt) -> Union[int, bool]:
+            """ False if any part of the query does not match.
+                If the query is longer >3 characters:
+                    * +10 for every query part that matches a title part beginning
+                        Ex: query 'te' -> +10 for these page titles:
+                            'test' or 'Journal:test' or 'foo test' or 'foo (test)'
+                    * +1 for every query part
+                        Ex: query 'st' -> +1 for those page titles
+
+                If the query is shorter <=3 characters:
+                    +10 for every query part that matches a title part beginning 'te' for 'test'
+                    False otherwise ('st' for 'test') so that you do not end up messed
+                     with page titles, after writing a single letter.
+            """
+            try:
+                if len(query) <= 3:
+                    # raises if subquery m does not match or is not at a page chunk beginning
+                    return sum(10 if m.group(1) is not None else None
+                               for m in (q.search(txt) for q in sub_queries_strict))
+                else:
+                    # raises if subquery m does not match
+                    return sum(10 if m.group(1) is not None else 1
+                               for m in (q.search(txt) for q in sub_queries_benevolent))
+            except (AttributeError, TypeError):  # one of the sub_queries is not part of the page title
+                return False
+
+        # we loop either all cached page titles or menu that should be built from previous superset-query menu
+        if not menu and isinstance(cached_titles, TitleCache):
+            cached_titles = cached_titles.candidates(query)
+        for path in list(menu) or cached_titles:  # quick search in titles
+            path_lower = path.casefold()
+            path_end = path_lower[path_lower.rfind(":") + 1:]
+            score = in_query(path_lower)
+
+            if score:  # 'te' matches 'test' or 'Journal:test' etc
+                # "foo" in "foo:bar", but not in "bar"
+                # when looping "foo:bar", page "foo" receives +1 for having a subpage
+                # if all(q in path.lower() for q in query) \
+                #         and any(q not in path.lower().split(":")[-1] for q in query):
+                # menu[":".join(path.split(":")[:-1])].bonus += 1  # 1 point for having a subpage
+
+                # Normally, zim search gives 11 points bonus if the search-string appears in the titles.
+                # If we are ignoring sub-pages, the search "foo" will match only page "journal:foo",
+                # but not "journal:foo:subpage"
+                # (and score of the parent page will get slightly higher by 1.)
+                # However, if there are occurrences of the string in the fulltext of the subpage,
+                # subpage remains in the result, but gets bonus only 2 points (not 11).
+                # But internal zim search is now disabled.
+                # menu[path].bonus = -11
+
+                # 10 points for title (zim default) (so that it gets displayed before the search finishes)
+                m = menu[path]
+                m.page_score += score  # will be added to score (score will be reset)
+                # if score > 9, it means this might be priority match, not fulltext page name search
+                # ex "te" for "test" is priority, whereas "st" is just fulltext
+                m.page_highlight = True if score > 9 else False
+                m.path = path
+
+                if not any(q in path_end for q in query.split()):
+                    m.page_insufficient = True
+                else:
+                    m.page_insufficient = False
+            else:  # remove the item from menu if it was there before
+                menu.pop(path, None)
+
+
+_markup_escapes = {"&": "&amp;", "<": "&lt;", ">": "&gt;", "'": "&#39;", '"': "&quot;"}
+_markup_special = re.compile("[&<>'\"\x01-\x08\x0b\x0c\x0e-\x1f\x7f-\x84\x86-\x9f]")
+_bold_tag = re.compile("</?b>")
+_broken_entity = re.compile("&[a-z]*<b[^;]*;")
+
+
+def markup_escape_text(text: str) -> str:
+    """ Escapes the text for the Pango markup, the same way as GLib.markup_escape_text. """
+    return _markup_special.sub(lambda m: _markup_escapes.get(m.group(0)) or f"&#x{ord(m.group(0)):x};", text)
+
+
+def markup_highlight(text: str, query: str) -> str:
+    """ Escapes the text for the Pango markup, the query terms in bold. """
+    markup = markup_escape_text(text)
+    # bold query chunks in the text
+    for q in QueryPlan.get(query).preview_regexes()[0]:
+        markup = q.sub(r"<b>\g<1></b>", markup)
+    # preserve markup_escape_text entities
+    # correct ex: '&a<b>m</b>p;' -> '&amp;' if searching for 'm'
+    return _broken_entity.sub(lambda m: _bold_tag.sub("", m.group(0)), markup)
+
+
+def get_preview_text(lines: List[str], query: str, preview_short=False) -> str:
+    """ Pango markup of the page preview, the query terms in bold, rendered at once. See Preview.
+        :param preview_short: Preview only matching lines. Otherwise whole page is displayed if not too long.
+    """
+    # check if the file is a Zim markup file and if so, skip header
+    if lines[0] == 'Content-Type: text/x-zim-wiki':
+        for i, line in enumerate(lines):
+            if line == "":
+                lines = lines[i + 1:]
+                break
+
+    preview = Preview("\n".join(lines) + "\n", query, preview_short)  # the new line keeps the last empty line
+    while preview.render() is not None:
+        pass
+    return preview.markup
+
+
+class Preview:
+    """ Pango markup of the page preview, the query terms in bold.
+
+        The preview is rendered lazily by windows of lines so that the visible part might be shown first
+        and the rest while the preview is being scrolled. The page is not split to lines as a whole:
+        unless a short page is shown whole, we jump from a query term occurrence to the next one,
+        either to the ones the fulltext search has recorded or to the ones found now.
+        The previews are cached by the page (and its mtime) and the query, see Preview.get.
+        Until rendered whole, a preview holds the page contents, see size.
+    """
+    max_lines = 200
+    window = 50  # number of the lines rendered at once
+    max_cached = 32  # number of the previews cached
+    max_cached_size = 4 * 2 ** 20  # approximate number of bytes the cached previews hold at most
+    _cache: "OrderedDict[tuple, Preview]" = OrderedDict()
+
+    def __init__(self, contents: str, query: str, preview_short=False, offsets: Optional[Iterable[int]] = None,
+                 offsets_complete=True):
+        """ :param preview_short: Preview only matching lines. Otherwise whole page is displayed if not too long.
+            :param offsets: sorted offsets of the query terms in the contents, if known
+            :param offsets_complete: False if there might be more occurrences after the last offset
+        """
+        self.query = query
+        self.lines = self.count_lines(contents)
+        self.windows: List[str] = []  # markup of the windows rendered so far
+        self.finished = False
+        self._lines = self._chosen_lines(contents, preview_short, offsets, offsets_complete)
+        self._pinned = 2 * len(contents)  # the contents and its lowered copy, see _finder
+
+    @classmethod
+    def get(cls, page: _FileCache, query: str, preview_short=False, offsets: Optional[array] = None) -> "Preview":
+        """ Preview of the cached page, rendered so far.
+            :param offsets: where the fulltext search found the query terms, see SearchController.fulltext_score
+        """
+        key = str(page.path), page.mtime, page.size, query, preview_short
+        preview = cls._cache.get(key)
+        if preview:
+            cls._cache.move_to_end(key)
+        else:
+            contents = page.contents.lstrip("\n")
+            if offsets:
+                # normalized indices to the contents offsets, converted only when the preview gets to them
+                shift = len(page.contents) - len(contents)
+                offsets_complete = len(offsets) < SearchController.max_offsets
+                offsets = (page.text.offset(i) - shift for i in offsets if i < len(page.text.body))
+            else:
+                offsets, offsets_complete = None, True
+            preview = cls._cache[key] = Preview(contents, query, preview_short, offsets, offsets_complete)
+            cls._evict()
+        return preview
+
+    @classmethod
+    def _evict(cls):
+        """ Drop the least recently used previews over the limits, the last one is kept. """
+        size = sum(preview.size for preview in cls._cache.values())
+        while len(cls._cache) > 1 and (len(cls._cache) > cls.max_cached or size > cls.max_cached_size):
+            _, preview = cls._cache.popitem(last=False)
+            size -= preview.size
+            preview.release()
+
+    @classmethod
+    def release_pending(cls):
+        """ Drop the previews not rendered whole, ex: when the dialog closes. They would hold the page contents. """
+        for key, preview in [(key, preview) for key, preview in cls._cache.items() if not preview.finished]:
+            del cls._cache[key]
+            preview.release()
+
+    @property
+    def size(self) -> int:
+        """ Approximate memory size: the markup rendered and, until rendered whole, the contents. """
+        return sum(len(markup) for markup in self.windows) + (self._pinned if self._lines else 0)
+
+    def release(self):
+        """ Close the lines generator, its frames hold the contents. The preview cannot be rendered further. """
+        if self._lines:
+            self._lines.close()
+            self._lines = None
+
+    @staticmethod
+    def count_lines(contents: str) -> int:
+        """ Number of the lines, the same as len(contents.splitlines() or [""]) for a text with the new lines only. """
+        return contents.count("\n") + (0 if contents.endswith("\n") else 1) if contents else 1
+
+    @property
+    def markup(self) -> str:
+        """ Markup of the preview rendered so far. """
+        return "\n".join(self.windows)
+
+    def render(self) -> Optional[str]:
+        """ Render the next window of lines. Returns its markup, None if the whole preview has been rendered. """
+        lines = list(islice(self._lines, self.window)) if self._lines else []
+        if not lines:
+            self.finished = True
+            self._lines = None  # the exhausted generator frees the contents
+            return None
+        if self.query.strip() == "":
+            markup = "\n".join(lines)
+        else:
+            markup = markup_highlight("\n".join(lines), self.query)
+        self.windows.append(markup)
+        return markup
+
+    @staticmethod
+    def _lines_from(contents: str, pos: int, find: Optional[Callable[[int], int]] = None) -> Generator[str, None, None]:
+        """ Lines from the position on. If find is given, only the lines it finds something in. """
+        while pos <= len(contents):
+            if find:
+                found = find(pos)
+                if found == -1:
+                    return
+                pos = contents.rfind("\n", 0, found) + 1
+            end = contents.find("\n", pos)
+            if end == -1:
+                end = len(contents)
+                if pos == end:  # no line after the last new line
+                    return
+            yield contents[pos:end]
+            pos = end + 1
+
+    @staticmethod
+    def _finder(contents: str, terms: List[str]) -> Callable[[int], int]:
+        """ Function finding the next occurrence of any of the terms from the position on, -1 if there is none. """
+        lowered = contents.lower()
+        if len(lowered) == len(contents):  # offsets are the same
+            found = {}  # the next occurrence of every term, -1 if there is none
+
+            def find(pos):
+                for q in terms:
+                    i = found.get(q)
+                    if i is None or -1 < i < pos:
+                        found[q] = lowered.find(q, pos)
+                return min((i for i in found.values() if i != -1), default=-1)
+        else:  # a letter got longer when lowered, ex: 'İ'
+            finder = re.compile("|".join(re.escape(q) for q in terms), re.IGNORECASE)
+
+            def find(pos):
+                m = finder.search(contents, pos)
+                return m.start() if m else -1
+        return find
+
+    def _chosen_lines(self, contents: str, preview_short: bool, offsets: Optional[Iterable[int]],
+                      offsets_complete: bool) -> Generator[str, None, None]:
+        lines = self._lines_from(contents, 0)
+        if self.query.strip() == "":
+            yield from islice(lines, self.max_lines)
+            return
+
+        plan = QueryPlan.get(self.query)
+        line_extract = plan.preview_regexes()[1]
+
+        # grep some lines
+        keep_all = not preview_short and self.lines < self.max_lines
+        first_line = next(lines, "")
+        yield first_line  # always include header as the first line, even if it does not contain the query
+        count = 1
+        if not keep_all and all(plan.terms):
+            # jump to the lines that contain a query chunk
+            if offsets is None:
+                find = self._finder(contents, plan.terms)
+            else:
+                # known occurrences first, then the search continues after the last of them if there might be more
+                offsets, search = iter(offsets), None
+
+                def find(pos):
+                    nonlocal search
+                    for i in offsets:
+                        if pos <= i < len(contents):
+                            return i
+                    if offsets_complete:
+                        return -1
+                    if not search:
+                        search = self._finder(contents, plan.terms)
+                    return search(pos)
+            lines = self._lines_from(contents, len(first_line) + 1, find)
+        for line in lines:
+            if count > self.max_lines:  # file is too long which would result the preview to not be smooth
+                break
+            count += 1
+            if len(line) > 100:
+                # however, this line is too long to display, try to extract query and its neighbourhood
+                s = "...".join("...".join(q.findall(line)) for q in line_extract).strip(".")
+                if not s:  # no query chunk was find on this line, the keep_all is True for sure
+                    yield line[:100] + "..."
+                else:
+                    yield "..." + s + "..."
+            else:
+                yield line
+        if not keep_all or count > self.max_lines:
+            # note that query might not been found, ex: query "foo" would not find line with a bold 'o': "f**o**o"
+            yield "..."
+
+
+class Engine:
+    """ Searches the notebook folder. Without Zim, the page names are derived from the file paths.
+
+        Ex:
+            engine = Engine(Path("~/Notebooks/Notes").expanduser())
+            for item in engine.search("economical"):
+                print(item.path, item.score + item.page_score)
+    """
+
+    def __init__(self, folder: Path, path2zim: Callable[[Path], ZimPath] = None, extension=".txt",
+                 processes=0, parallel_threshold=2000, index: Optional[TrigramIndex] = None,
+                 store: Optional[PageStore] = None, snippets=True):
+        """
+        :param path2zim: Page of the file. Zim notebook layout when run by the plugin.
+        :param processes: Number of processes for the parallel fulltext search (0 to disable).
+        :param parallel_threshold: Search in parallel only if there are at least this number of pages.
+        :param index: Fulltext index narrowing the pages to be searched.
+        :param store: On-disk copy of the page contents cache of the notebook, closed by shutdown.
+        :param snippets: The fulltext search takes a snippet of every matching page, see State.snippet.
+        """
+        self.folder = folder
+        self.extension = extension
+        # Why the slash "/" after the notebook folder? #51
+        # If the notebook sits on the root dir in Windows, joining the notebook path "G:"
+        # and the file names produces path like "G:file.txt" which is a perfectly valid Windows path.
+        # Missing slash means relative CWD on the drive G in Windows system
+        # but Zim seems not to be aware of such a strange Windows behaviour. Hence, putting it into
+        # self.window.notebook.layout.map_file / base.FilePath.relpath gives ValueError 'Not a parent path G:'.
+        # Resolving files to the absolute paths by `f.resolve()` might fail as well because the drive G:
+        # may point to another folder like C:\mount, and C:\mount\file.txt is not under the notebook parent
+        # path "G:" as well.
+        # The best solution is to force the notebook folder to have the slash to be sure we get such
+        # half-absolute paths.
+        # It's IMHO the bug of the Zim that it does not include trailing slash which is ok till the dir
+        # is the root drive, while the path reported becomes relative ("G:" – relative to CWD on G, "G:\\" – absolute).
+        self.manifest = Manifest(Path(abspath(str(folder))), extension, path2zim or self.page_name)
+        self.path2zim = self.manifest.page  # shared by the search and the preview
+        self.processes = processes
+        self.parallel_threshold = parallel_threshold
+        self.index = index
+        self.store = store
+        if store:  # the page contents cache is shared by the notebooks, every notebook has its own store
+            file_cache.stores[self.manifest.folder] = store
+        self._store_trimmed = False  # the stored pages of the removed files are dropped after the first walk
+        self.snippets = snippets
+        self.titles = TitleCache()
+        self.states = StateCache()  # results of the queries searched in this notebook
+        # A single process pool per worker so that a page is always searched by the same worker, see _parallel_scan.
+        # They stay warm between searches.
+        self._pools: List[ProcessPoolExecutor] = []
+
+    def page_name(self, path: Path) -> ZimPathStr:
+        """ Page name of the file, decoded the way Zim encodes the file names.
+            Ex: "Foo/Bar_baz.txt" -> "Foo:Bar baz"
+        """
+        return ":".join(unquote(part).replace("_", " ") for part in path.relative_to(self.folder).with_suffix("").parts)
+
+    def paths(self) -> Iterable[Path]:
+        """ All the page files of the notebook. The folders are walked once iterated, ex: in the search thread. """
+        paths = self.manifest.paths()
+        if self.store and not self._store_trimmed:
+            self._store_trimmed = True
+            self.store.trim(paths)
+        yield from paths
+
+    def search_paths(self, state: State) -> Tuple[Iterable[Path], bool]:
+        """ Paths to be searched through for the state and whether they are all the notebook files.
+            Loop either all files in the notebook or narrow the search with a previous state
+            (even with a state whose search was cancelled, if we know which files remained unscanned).
+        """
+        if state.previous and state.previous.candidate_paths is not None:
+            return state.previous.candidate_paths, False
+        return self.paths(), True
+
+    def search(self, raw_query: str, limit: Optional[int] = None) -> List[_MenuItem]:
+        """ Search the notebook for the query, the same way as the dialog does when the query is typed.
+            Returns the results sorted by their score.
+            :param limit: number of the best results returned, all of them by default
+        """
+        if not self.titles.is_built:
+            self.titles.build(str(self.path2zim(path)) for path in self.paths())
+        state = self.states.set_current(raw_query)
+        if not state.is_finished:
+            if not state.first_seen:
+                state.restart()
+            if state.query:
+                with state.metrics.timer("header_search"):
+                    SearchController.header_search(state.query, state.menu, self.titles)
+            if not state.page_name_only:
+                scores: Dict[ZimPathStr, int] = {}
+                scan = state.new_scan()
+                paths, complete = self.search_paths(state)
+                if self.scan(state, scan, paths, complete, lambda page, score: scores.update({str(page): score})):
+                    state.add_scores(scores)
+                    state.scan_finished(scan)
+        state.sort_items(limit=limit or len(state.menu))
+        return state.items
+
+    def scan(self, state: State, scan: Scan, paths: Iterable[Path], complete: bool,
+             on_match: Callable[[ZimPath, int], None], first: Iterable[Path] = ()) -> bool:
+        """ Zim internal search is not able to find out text with markup.
+                 Ex:
+                  'economical' is not recognized as 'economi**cal**' (however highlighting works great),
+                                                 as 'economi[[inserted link]]cal'
+                                                 as 'any text with [[http://economical.example.com|link]]'
+
+                 This fulltext search loops all .txt files in the notebook directory
+                 and tries to recognize the patterns.
+
+                 Might run in a thread, on_match(page, score) is called from that thread.
+                 Returns False if cancelled because the user has typed another query.
+        """
+        slices = self.scan_slices(state, scan, paths, complete, on_match, first)
+        while True:
+            try:
+                next(slices)
+            except StopIteration as finished:
+                return finished.value
+
+    def scan_slices(self, state: State, scan: Scan, paths: Iterable[Path], complete: bool,
+                    on_match: Callable[[ZimPath, int], None], first: Iterable[Path] = (),
+                    budget: Optional[float] = None) -> Generator[None, None, bool]:
+        """ The same as scan but yields whenever the budget (in seconds) is spent so that the caller
+            might do something else meanwhile. The paths are walked and the index is updated in a thread
+            since they cannot be interrupted, the slices only wait for them.
+            :param first: paths most likely to be searched for, scanned before the others
+        """
+        start, snapshot, metrics = perf_counter(), Metrics.snapshot(), state.metrics
+        try:
+            if budget is None:
+                paths = self._scanned_paths(state, paths, complete)
+            else:
+                with ThreadPoolExecutor(1) as executor:
+                    future = executor.submit(self._scanned_paths, state, paths, complete)
+                    while not wait([future], timeout=budget).done:
+                        yield
+                    paths = future.result()
+            if first:
+                candidates = set(paths)
+                first = [path for path in dict.fromkeys(first) if path in candidates]
+                if first:
+                    first_set = set(first)
+                    paths = first + [path for path in paths if path not in first_set]
+
+            # The page contents cache is kept between the dialog sessions.
+            # A page is re-read only if its file mtime or size has changed since (checked once per dialog session,
+            # or only when the page is reported changed if the plugin watches the notebook folder).
+            if self.processes and len(paths) >= self.parallel_threshold:
+                return (yield from self._parallel_scan(state, scan, paths, on_match, budget))
+            return (yield from self._serial_scan(state, scan, paths, on_match, budget))
+        finally:
+            metrics["scan_s"] += perf_counter() - start  # including the time between the slices
+            metrics.add_since(snapshot)
+
+    def _scanned_paths(self, state: State, paths: Iterable[Path], complete: bool) -> List[Path]:
+        """ Walk the notebook folder and narrow the paths with the index. """
+        metrics = state.metrics
+        # walk the notebook folder now so that we know the paths left if the scan is cancelled
+        with metrics.timer("paths"):
+            paths = list(paths)
+        metrics["files"] += len(paths)
+        if self.index:
+            # skip the pages that certainly do not contain the query terms
+            try:
+                with metrics.timer("index"):
+                    self.index.update(paths, self.path2zim, complete=complete)
+                    paths = self.index.filter(paths, state.query)
+                metrics["files_filtered"] += len(paths)
+            except (sqlite3.Error, OSError) as err:
+                logger.warning("[Instantsearch] Fulltext index not available: %s", err)
+        return paths
+
+    def _serial_scan(self, state: State, scan: Scan, paths: List[Path], on_match: Callable[[ZimPath, int], None],
+                     budget: Optional[float]):
+        start = slice_start = perf_counter()
+
+        for i, path in enumerate(paths):
+            if budget is not None and perf_counter() - slice_start > budget:
+                yield
+                slice_start = perf_counter()
+            if not i % Scan.check_interval and scan.cancelled:  # superseded by a newer query
+                # a narrower query may still use the partial results
+                state.scan_cancelled(scan, paths[i:])
+                logger.info("[Instantsearch] External search cancelled: %g s", perf_counter() - start)
+                return False
+            offsets = array("i")
+            result = SearchController.file_score(state.query, path, self.path2zim, offsets)
+            if result:
+                snippet = SearchController.file_snippet(state.query, path, offsets) \
+                    if self.snippets and result[2] else ""
+                self._count_result(scan, path, *result, offsets, snippet, on_match)
+
+        logger.info("[Instantsearch] External search: %g s", perf_counter() - start)
+        return True
+
+    def _parallel_scan(self, state: State, scan: Scan, paths: List[Path], on_match: Callable[[ZimPath, int], None],
+                       budget: Optional[float]):
+        """ The pages are divided into chunks that are scored in the worker processes.
+            Every worker has its own page contents cache. A page is always sent to the same worker,
+            chosen by the hash of its path, so that the worker has it cached from the previous searches.
+        """
+        start = perf_counter()
+        if not self._pools:
+            # forking the process with GTK and the search threads running is not safe
+            stores = {self.manifest.folder: self.store.db_path} if self.store else {}
+            self._pools = [ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn"),
+                                               initializer=_init_worker,
+                                               initargs=(file_cache.max_size // self.processes, stores))
+                           for _ in range(self.processes)]
+        zim_paths = {path: self.path2zim(path) for path in paths}
+        worker_pages: List[List[Tuple[Path, str]]] = [[] for _ in self._pools]
+        for path, zim_path in zim_paths.items():
+            worker_pages[hash(path) % len(self._pools)].append((path, str(zim_path)))
+        changes = file_cache.changes()  # the workers must not use the pages changed since they have read them
+        chunks = {}
+        for pool, pages in zip(self._pools, worker_pages):
+            # more chunks than workers so that the results stream in
+            size = max(1, ceil(len(pages) / 4))
+            chunks.update({pool.submit(SearchController.fulltext_chunk, state.query, pages[i:i + size],
+                                       self.snippets, changes): pages[i:i + size]
+                           for i in range(0, len(pages), size)})
+
+        try:
+            pending = set(chunks)
+            while pending:
+                if scan.cancelled:  # superseded by a newer query
+                    [f.cancel() for f in chunks]
+                    state.scan_cancelled(scan, [path for chunk in chunks.values() for path, _ in chunk])
+                    logger.info("[Instantsearch] Parallel external search cancelled: %g s", perf_counter() - start)
+                    return False
+                done, pending = wait(pending, timeout=budget, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results, stats = future.result()
+                    for path, score, matched, offsets, snippet in results:
+                        self._count_result(scan, path, zim_paths[path], score, matched, offsets, snippet, on_match)
+                    SearchController.stats.update(stats)  # counted by the worker
+                    del chunks[future]
+                if budget is not None:
+                    yield
+        except (BrokenProcessPool, OSError) as err:
+            logger.warning("[Instantsearch] Parallel search not available, searching serially: %s", err)
+            self._shutdown_pools()
+            self.processes = 0
+            # the chunks already counted are done
+            return (yield from self._serial_scan(state, scan, [path for chunk in chunks.values() for path, _ in chunk],
+                                                 on_match, budget))
+
+        logger.info("[Instantsearch] Parallel external search: %g s", perf_counter() - start)
+        return True
+
+    @staticmethod
+    def _count_result(scan: Scan, path: Path, zim_path: ZimPath, score: int, matched: bool, offsets: array,
+                      snippet: str, on_match: Callable[[ZimPath, int], None]):
+        scan.matching_files.append(path)
+        if matched:
+            if offsets:
+                scan.offsets[path] = offsets
+            if snippet:
+                scan.snippets[str(zim_path)] = snippet
+            on_match(zim_path, score)
+
+    def page_changed(self, path: Path):
+        """ The page file has been changed, created or removed, inside or outside Zim.
+            Only the cached data of the page and the cached results it might change are invalidated.
+        """
+        file_cache.invalidate(path)
+        if self.index:
+            self.index.invalidate(path)
+
+        def affected(state: State):
+            if state.page_name_only:  # page contents are not searched
+                return False
+            if not state.is_finished:  # we do not know whether the page has been scanned already
+                return True
+            # the page either matched before or matches now
+            return path in state.matching_files or bool(SearchController.file_score(state.query, path, self.path2zim))
+        self.states.invalidate(affected)
+
+    def title_changed(self, title: ZimPathStr, removed=False):
+        """ A page has been added to or removed from the notebook. """
+        if removed:
+            self.titles.remove(title)
+        else:
+            self.titles.add(title)
+
+        def affected(state: State):
+            if not state.query:
+                return False
+            if title in state.menu:
+                return True
+            if removed:  # a removed title affects only the results it is in
+                return False
+            menu: Menu = defaultdict(_MenuItem)
+            SearchController.header_search(state.query, menu, [title])
+            return bool(menu)
+        self.states.invalidate(affected)
+
+    def _shutdown_pools(self):
+        for pool in self._pools:
+            pool.shutdown(wait=False)
+        self._pools = []
+
+    def shutdown(self):
+        self._shutdown_pools()
+        if self.store:
+            if file_cache.stores.get(self.manifest.folder) is self.store:
+                del file_cache.stores[self.manifest.folder]
+            self.store.close()
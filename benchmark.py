@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Benchmark of the Instant Search plugin on synthetic notebooks.
+#
+# Generates Zim notebooks of the given sizes (pages with headings, markup and links) and simulates
+# typing the query sequences letter by letter, as the dialog does. Timed for every typed query:
+#   * header: creating the State and SearchController.header_search over the page titles
+#   * fulltext: the fulltext scan of the notebook files (narrowed by the previous query, as in the plugin)
+#   * preview: rendering the first window of the preview of the first matching page
+#
+# The engine does not need GTK nor Zim. They are mocked so that the plugin package (its preferences) can be imported.
+# Results are printed as JSON so that they might be compared between the plugin versions.
+#
+# Usage:
+#   python benchmark.py                                     # 1k, 10k and 100k pages
+#   python benchmark.py --pages 1000 --output 1.3.1.json    # save results to a file
+#   python benchmark.py --index                             # use the fulltext trigram index
+#
+import builtins
+import json
+import platform
+import random
+import re
+import sys
+from argparse import ArgumentParser
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter, strftime
+from types import ModuleType
+from typing import List
+from unittest.mock import MagicMock
+
+DEFAULT_PAGES = (1000, 10000, 100000)
+# query typing sequences, every prefix of them is searched
+DEFAULT_SEQUENCES = ("linux f", "economical", "!proj", "meeting notes", "tour hou", "xyzzy")
+
+# vocabulary of the generated pages, the first words appear more often than the last ones
+WORDS = ("the of and to in is for on that with as by this from at be are it or an was was not have "
+         "linux kernel project meeting notes economical tour house contour silhouette foo bar server "
+         "backup install config network python script release budget invoice report draft idea todo "
+         "garden recipe travel book film music family health sport car bike phone laptop monitor "
+         "database query index search cache thread process memory disk file folder window dialog "
+         "ubuntu debian windows zim wiki page link heading bold italic strike verbatim journal").split()
+
+
+def mock_gui():
+    """ Let the plugin be imported without GTK and Zim. """
+    builtins._ = lambda s: s  # Zim installs the gettext function
+
+    glib = MagicMock(name="GLib")
+    repository = ModuleType("gi.repository")
+    repository.GLib, repository.GObject, repository.Gio, repository.Gtk, repository.Gdk, repository.Pango = \
+        glib, MagicMock(), MagicMock(), MagicMock(), MagicMock(), MagicMock()
+    gi = ModuleType("gi")
+    gi.repository, gi.require_version = repository, lambda *_: None
+
+    class Stub:
+        def __init__(self, *args, **kwargs):
+            pass
+
+    class ZimPath:
+        def __init__(self, name):
+            self.name = name.strip(":")
+
+        def __str__(self):
+            return self.name
+
+        def __eq__(self, other):
+            return isinstance(other, ZimPath) and other.name == self.name
+
+        def __hash__(self):
+            return hash(self.name)
+
+    modules = {"gi": gi, "gi.repository": repository, "gi.repository.GLib": glib,
+               "zim.actions": dict(action=lambda *_, **__: lambda f: f),
+               "zim.gui.mainwindow": dict(MainWindow=Stub, MainWindowExtension=Stub),
+               "zim.gui.pageview": dict(FIND_REGEX=4),
+               "zim.gui.widgets": dict(Dialog=Stub, InputEntry=Stub),
+               "zim.history": dict(HistoryList=Stub),
+               "zim.newfs": dict(File=Stub, LocalFile=Stub),
+               "zim.notebook": dict(Page=Stub, Path=ZimPath),
+               "zim.plugins": dict(PluginClass=Stub),
+               "zim.search": dict(Query=Stub, SearchSelection=Stub),
+               "zim": {}, "zim.gui": {}}
+    for name, attributes in modules.items():
+        if isinstance(attributes, dict):
+            sys.modules[name] = ModuleType(name)
+            sys.modules[name].__dict__.update(attributes)
+        else:
+            sys.modules[name] = attributes
+
+
+def generate_notebook(folder: Path, count: int, seed=0) -> List[str]:
+    """ Writes the notebook pages. Returns the page names. """
+    rnd = random.Random(seed)
+    weights = [1 / (i + 1) for i in range(len(WORDS))]
+
+    def words(k):
+        return rnd.choices(WORDS, weights, k=k)
+
+    names, taken = [], set()
+    while len(names) < count:
+        parent = rnd.choice(names[-50:]) if names and rnd.random() < .6 else ""
+        name = (parent + ":" if parent else "") + " ".join(words(rnd.randint(1, 2))).capitalize()
+        if name in taken:
+            name += " " + str(len(names))
+        names.append(name)
+        taken.add(name)
+
+    for name in names:
+        lines = ["Content-Type: text/x-zim-wiki", "Wiki-Format: zim 0.6", "Creation-Date: 2023-01-01T10:00:00+01:00",
+                 "", f"====== {name.rpartition(':')[2]} ======", "Created Sunday 01 January 2023", ""]
+        for _ in range(rnd.randint(3, 30)):
+            kind = rnd.random()
+            if kind < .1:
+                lines.append("===== " + " ".join(words(rnd.randint(1, 4))).capitalize() + " =====")
+                continue
+            line = words(rnd.randint(3, 25))
+            for i in range(len(line)):
+                decoration = rnd.random()
+                if decoration < .03:
+                    line[i] = "**" + line[i] + "**"
+                elif decoration < .05:
+                    line[i] = "//" + line[i] + "//"
+                elif decoration < .06:
+                    line[i] = line[i][:2] + "**" + line[i][2:] + "**"  # markup in the middle of a word
+                elif decoration < .08:
+                    line[i] = "[[" + rnd.choice(names) + "]]"
+                elif decoration < .085:
+                    line[i] = f"[[https://{line[i]}.example.com|{rnd.choice(WORDS)}]]"
+            prefix = "* " if kind < .3 else "[ ] " if kind < .35 else ""
+            lines.append(prefix + " ".join(line))
+        path = folder.joinpath(*name.split(":")).with_suffix(".txt")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+    return names
+
+
+def benchmark(count: int, sequences: List[str], use_index=False):
+    from instantsearch import InstantSearchPlugin
+    from _instantsearch_engine import Engine, Preview, SearchController, State, TrigramIndex, file_cache
+
+    preferences = {key: default for key, _type, _label, default, *_ in InstantSearchPlugin.plugin_preferences}
+    State.title_match_char = preferences["title_match_char"]
+    State.start_search_length = preferences["start_search_length"]
+
+    with TemporaryDirectory() as tmp:
+        folder = Path(tmp, "notebook")
+        start = perf_counter()
+        names = generate_notebook(folder, count)
+        result = {"pages": count,
+                  "generate_s": round(perf_counter() - start, 3),
+                  "notebook_bytes": sum(f.stat().st_size for f in folder.rglob("*.txt")),
+                  "sequences": {}}
+
+        engine = Engine(folder, lambda path: ":".join(path.relative_to(folder).with_suffix("").parts),
+                        index=TrigramIndex(Path(tmp, "instantsearch.sqlite")) if use_index else None)
+        start = perf_counter()
+        engine.titles.build(names)
+        result["titles_build_ms"] = round((perf_counter() - start) * 1000, 3)
+
+        for sequence in sequences:
+            engine.states.reset()
+            file_cache.clear()
+            if engine.index:
+                engine.index.invalidate()
+            steps = result["sequences"][sequence] = []
+            for i in range(1, len(sequence) + 1):
+                step = {"query": sequence[:i]}
+                steps.append(step)
+
+                # page titles, as in InstantSearchMainWindowExtension.change and start_search
+                start = perf_counter()
+                state = engine.states.set_current(sequence[:i])
+                if state.query:
+                    SearchController.header_search(state.query, state.menu, engine.titles)
+                step["header_ms"] = round((perf_counter() - start) * 1000, 3)
+
+                # fulltext, as in InstantSearchMainWindowExtension.start_zim_search and _search_finished
+                if not state.page_name_only:
+                    scores = {}
+                    start = perf_counter()
+                    scan = state.new_scan()
+                    paths, complete = engine.search_paths(state)
+                    engine.scan(state, scan, paths, complete, lambda page, score: scores.update({page: score}))
+                    state.add_scores(scores)
+                    state.scan_finished(scan)
+                    step["fulltext_ms"] = round((perf_counter() - start) * 1000, 3)
+                    step["matching_files"] = len(state.matching_files)
+                step["menu"] = len(state.menu)
+
+                # preview of the first result, as in _open_page_preview
+                if state.menu and state.query:
+                    name = next(iter(state.menu))
+                    path = folder.joinpath(*name.split(":")).with_suffix(".txt")
+                    cached = file_cache.get(path, engine.path2zim)
+                    start = perf_counter()
+                    if cached:
+                        Preview.get(cached, state.query, preferences["preview_short"],
+                                    state.match_offsets(path)).render()
+                    step["preview_ms"] = round((perf_counter() - start) * 1000, 3)
+
+        if engine.index:
+            engine.index.invalidate()
+        result["totals"] = {key: round(sum(step.get(key, 0) for steps in result["sequences"].values()
+                                           for step in steps), 3)
+                            for key in ("header_ms", "fulltext_ms", "preview_ms")}
+    return result
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark of the Instant Search plugin on synthetic notebooks.")
+    parser.add_argument("--pages", type=int, nargs="+", default=DEFAULT_PAGES, help="notebook sizes")
+    parser.add_argument("--sequences", nargs="+", default=DEFAULT_SEQUENCES, help="typed queries")
+    parser.add_argument("--index", action="store_true", help="use the fulltext trigram index")
+    parser.add_argument("--output", help="JSON file to write the results to, instead of the standard output")
+    args = parser.parse_args()
+
+    mock_gui()
+    sys.path.insert(0, str(Path(__file__).parent))
+    changelog = Path(__file__).with_name("CHANGELOG")
+    version = re.match(r"# (\S+)", changelog.read_text()).group(1) if changelog.exists() else None
+
+    results = {"version": version,
+               "date": strftime("%Y-%m-%d %H:%M:%S"),
+               "python": platform.python_version(),
+               "platform": platform.platform(),
+               "index": args.index,
+               "notebooks": [benchmark(count, args.sequences, args.index) for count in args.pages]}
+    output = json.dumps(results, indent=2)
+    if args.output:
+        Path(args.output).write_text(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,932 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Search instantly as you type. Edvard Rejthar
+# https://github.com/e3rd/zim-plugin-instantsearch
+#
+# Note that the search might not work well in case of case-folded letters
+# because re.IGNORECASE seem to perform str.lower only. A fix might be implemented if requested.
+# Use case:
+#   re.match("tsChüß".casefold(), "Tschüß".casefold()) # matches
+#   re.match("tsChüss", "Tschüß", re.IGNORECASE) # does not match
+#
+#
+import json
+import os
+import re
+from collections import OrderedDict
+from pathlib import Path
+from itertools import islice
+from threading import Thread
+from time import perf_counter, strftime, time
+from types import SimpleNamespace
+from typing import Generator, Iterable, List
+
+from gi.repository import GLib, GObject, Gio, Gtk, Gdk, Pango
+from zim.actions import action
+from zim.gui.mainwindow import MainWindow, MainWindowExtension
+from zim.gui.pageview import FIND_REGEX
+from zim.gui.widgets import Dialog
+from zim.gui.widgets import InputEntry
+from zim.history import HistoryList
+from zim.newfs import File, LocalFile
+from zim.notebook import Page, Path as ZimPath
+from zim.plugins import PluginClass
+from zim.search import Query, SearchSelection
+
+if "." in __name__:  # loaded by Zim as zim.plugins.instantsearch, the engine module lies next to the plugin folder
+    from .._instantsearch_engine import Engine, Manifest, PageStore, Preview, Scan, SearchController, State, \
+        TitleCache, TrigramIndex, ZimPathStr, file_cache, logger, markup_highlight
+else:  # imported from the repository, ex: by the benchmark
+    from _instantsearch_engine import Engine, Manifest, PageStore, Preview, Scan, SearchController, State, \
+        TitleCache, TrigramIndex, ZimPathStr, file_cache, logger, markup_highlight
+
+
+class InstantSearchPlugin(PluginClass):
+    plugin_info = {
+        'name': _('Instant Search'),  # T: plugin name
+        'description': _('''\
+Instant search allows you to filter as you type feature known from I.E. OneNote.
+When you hit Ctrl+E, small window opens, in where you can type.
+As you type third letter, every page that matches your search is listed.
+You can walk through by UP/DOWN arrow, hit Enter to stay on the page, or Esc to cancel.
+ Much quicker than current Zim search.
+
+(V1.2)
+'''),
+        'author': "Edvard Rejthar"
+
+    }
+
+    POSITION_CENTER = _('center')  # T: option value
+    POSITION_RIGHT = _('right')  # T: option value
+
+    PREVIEW_ONLY = "preview_only"
+    PREVIEW_THEN_FULL = "preview_then_full"
+    FULL_ONLY = "full_only"
+
+    PREVIEW_MODE = (
+        (PREVIEW_THEN_FULL, _('Preview then full view')),
+        (PREVIEW_ONLY, _('Preview only')),
+        (FULL_ONLY, _('Full view only')),
+    )
+
+    plugin_preferences = (
+        # T: label for plugin preferences dialog
+        ('title_match_char', 'string', _('Match title only if query starting by this char'), "!"),
+        ('start_search_length', 'int', _('Start the search when number of letters written'), 3, (0, 10)),
+        ('keystroke_delay', 'int', _('Keystroke delay before search'), 150, (0, 5000)),
+        ('keystroke_delay_open', 'int', _('Keystroke delay for opening page in full view'
+                                          '\n(Low value might prevent search list smooth navigation'
+                                          ' if page is big.)'), 1500, (0, 5000)),
+        ('preview_mode', 'choice', _('Preview mode'), PREVIEW_THEN_FULL, PREVIEW_MODE),
+        ('preview_short', 'bool', _('Preview only matching lines'
+                                    '\nOtherwise whole page is displayed if not too long.)'), False),
+        ('highlight_search', 'bool', _('Highlight search'), True),
+        ('preload_pages', 'bool', _('Parse the likely next pages in advance while the dialog is idle'
+                                    '\n(Opening a page in full view is faster. The dialog does not respond'
+                                    ' while a page is being parsed.)'), False),
+        ('snippets', 'bool', _('Show the matching text of the pages in the result list'), True),
+        ('ignore_subpages', 'bool', _("Ignore sub-pages (if ignored, search 'linux'"
+                                      " would return page:linux but not page:linux:subpage"
+                                      " (if in the subpage, there is no occurrence of string 'linux')"), True),
+        # ('is_cached', 'bool',
+        #  _("Cache results of a search to be used in another search. (Till the end of zim process.)"), True),
+        ('open_when_unique', 'bool', _('When only one page is found, open it automatically.'), True),
+        ('results_shown', 'int', _('Number of results shown at once'
+                                   '\n(More are shown when moving down past the last one.)'), 50, (1, 10000)),
+        ('cache_size', 'int', _('Memory limit for cached page contents (MB)'), 100, (0, 10000)),
+        ('page_store', 'bool', _('Keep the cached page contents in the notebook cache folder'
+                                 '\n(The first search after Zim starts is faster.)'), True),
+        ('search_processes', 'int', _('Number of processes for the parallel fulltext search (0 to disable)'), 0,
+         (0, 128)),
+        ('parallel_threshold', 'int', _('Search in parallel only if there are at least this number of pages'), 2000,
+         (0, 1000000)),
+        ('fulltext_index', 'bool', _('Keep a fulltext index in the notebook cache folder'
+                                     '\n(Speeds up searching big notebooks.)'), False),
+        ('search_slice', 'int', _('Search in the main loop for at most this number of ms at once'
+                                  '\n(0 to search in a background thread)'), 0, (0, 1000)),
+        ('metrics_log', 'string', _('Append the metrics of every search to this JSON lines file'
+                                    '\n(Empty to disable. F12 in the dialog shows them.)'), ""),
+        ('position', 'choice', _('Popup position'), POSITION_RIGHT, (POSITION_RIGHT, POSITION_CENTER))
+    )
+
+
+class InstantSearchMainWindowExtension(MainWindowExtension):
+    gui: "Dialog"
+    state: State
+    titles: TitleCache
+    window: MainWindow
+    likely_pages = 20  # number of the title hits and of the recent pages that are searched first
+    max_monitors = 5000  # number of the notebook folders watched at most, see start_monitoring
+    monitor_batch = 50  # number of the folders watched at once in the idle time, see _watch_folders
+    preloaded_kept = 5  # number of the pages parsed in advance kept, see _preload
+    preload_max_size = 256 * 2 ** 10  # bigger pages are not parsed in advance, the dialog would freeze meanwhile
+    prevent_closing = False  # if `open_when_unique` is active, having single query in the result would immediately re-close the dialog
+
+    def __init__(self, plugin, window):
+        super().__init__(plugin, window)
+        self.timeout = None
+        self.timeout_open_page = None  # will open page after keystroke delay
+        self.timeout_open_page_preview = None  # will open page after keystroke delay
+        self.timeout_preload = None  # will parse the likely next pages when idle
+        self.timeout_monitoring = None  # will watch the notebook folders when idle
+        self.preload_scheduled: List[ZimPathStr] = []  # pages to be parsed in advance, see _schedule_preload
+        # Zim keeps the Page objects (and their parse trees) weakly referenced, we hold the ones parsed in advance
+        self.preloaded: "OrderedDict[str, Page]" = OrderedDict()
+        self.last_query = None
+        self.query_o = None
+        self.caret = None
+        self.original_page = None
+        self.original_history = None
+        self.selection = None
+        self.menu_page = None
+        self.is_closed = None
+        self.last_page = self.last_page_preview = None
+        self.results = self.results_view = None
+        self.input_entry = None
+        self.preview = None  # Preview shown
+        self.preview_box = None
+        self.preview_pane = None
+        self.metrics_label = None  # debug pane with the metrics of the current search, toggled by F12
+        self.show_metrics = False
+        self._last_update = 0
+        self._update_pending = False  # the search thread has scheduled the results update in the main loop
+        self.state = None
+        self.caret = SimpleNamespace(pos=0, text="", stick=False)  # cursor position
+        # watched notebook folders {folder: Gio.FileMonitor}, None if not started, False if they cannot be watched
+        self.monitors = None
+        self.monitors_complete = False  # every folder of the last notebook walk is watched
+
+        # preferences
+        State.title_match_char = self.plugin.preferences['title_match_char']
+        State.start_search_length = self.plugin.preferences['start_search_length']
+        State.results_shown = self.plugin.preferences['results_shown']
+        self.keystroke_delay_open = self.plugin.preferences['keystroke_delay_open']
+        self.keystroke_delay = self.plugin.preferences['keystroke_delay']
+        file_cache.max_size = self.plugin.preferences['cache_size'] * 2 ** 20
+        self.search_slice = self.plugin.preferences['search_slice'] / 1000
+        notebook = self.window.notebook
+        self.engine = Engine(Path(str(notebook.folder)), self._path2zim,
+                             extension=notebook.config["Notebook"]["default_file_extension"],  # ex: ".txt"
+                             processes=self.plugin.preferences['search_processes'],
+                             parallel_threshold=self.plugin.preferences['parallel_threshold'],
+                             index=TrigramIndex(Path(str(notebook.cache_dir), "instantsearch.sqlite"))
+                             if self.plugin.preferences['fulltext_index'] else None,
+                             store=PageStore(Path(str(notebook.cache_dir), "instantsearch-pages.sqlite"))
+                             if self.plugin.preferences['page_store'] else None,
+                             snippets=self.plugin.preferences['snippets'])
+        if self.engine.store:
+            # pages read during the previous Zim run are loaded in the background, the plugin start is not delayed
+            Thread(target=file_cache.load, args=(self.engine.store, self.engine.path2zim), daemon=True).start()
+
+        # page titles are built at the first search and then kept up to date with the notebook index
+        self.titles = self.engine.titles
+        pages_indexer = self.window.notebook.index.update_iter.pages
+        self.connectto(pages_indexer, 'page-row-inserted', self.on_page_row_inserted)
+        self.connectto(pages_indexer, 'page-row-deleted', self.on_page_row_deleted)
+        # cached search results get stale when a page is saved
+        self.connectto(self.window.notebook, 'stored-page', self.on_stored_page)
+
+    def on_page_row_inserted(self, o, row):
+        self.engine.title_changed(row['name'])
+
+    def on_page_row_deleted(self, o, row):
+        self.engine.title_changed(row['name'], removed=True)
+
+    def on_stored_page(self, o, page):
+        self.engine.page_changed(Path(str(self.window.notebook.layout.map_page(page)[0])))
+
+    def start_monitoring(self):
+        """ Watch the notebook folders so that the pages changed outside Zim are invalidated as they change.
+            Then the cached page contents need not be checked against the disk on every dialog opening.
+            If the folders cannot be watched, the file mtimes are checked once per dialog session as before.
+
+            Called when a search finishes: the folders are the ones the search has just walked (Manifest.folders),
+            they are watched a batch at once in the idle time so that the first search does not wait for them.
+        """
+        if self.monitors is False or self.monitors_complete or self.timeout_monitoring \
+                or not self.engine.manifest.folders():  # the search has not walked the notebook yet
+            return
+        if self.monitors is None:
+            self.monitors = {}
+        self.timeout_monitoring = GLib.idle_add(self._watch_folders, priority=GLib.PRIORITY_LOW)
+
+    def stop_monitoring(self, watched=None):
+        if self.timeout_monitoring:
+            GObject.source_remove(self.timeout_monitoring)
+            self.timeout_monitoring = None
+        for monitor in (self.monitors or {}).values():
+            monitor.cancel()
+        self.monitors = watched
+        self.monitors_complete = False
+
+    def _watch_folders(self):
+        """ Gio monitors do not watch the sub-folders, every folder gets its own monitor. """
+        folders = [f for f in self.engine.manifest.folders() if f not in self.monitors]
+        try:
+            if len(self.monitors) + len(folders) > self.max_monitors:
+                raise OSError(f"more than {self.max_monitors} folders")
+            for folder in folders[:self.monitor_batch]:
+                monitor = Gio.File.new_for_path(str(folder)).monitor_directory(Gio.FileMonitorFlags.WATCH_MOVES, None)
+                monitor.connect('changed', self.on_file_changed)
+                self.monitors[folder] = monitor
+        except (GLib.Error, OSError) as err:
+            logger.warning("[Instantsearch] Notebook folder not watched: %s", err)
+            self.timeout_monitoring = None
+            self.stop_monitoring(watched=False)
+            return False
+        if len(folders) > self.monitor_batch:
+            return True  # watch the next batch in the next idle time
+        self.timeout_monitoring = None
+        self.monitors_complete = True
+        return False
+
+    def on_file_changed(self, monitor, file, other_file, event):
+        if event not in (Gio.FileMonitorEvent.CHANGES_DONE_HINT, Gio.FileMonitorEvent.CREATED,
+                         Gio.FileMonitorEvent.DELETED, Gio.FileMonitorEvent.MOVED_IN,
+                         Gio.FileMonitorEvent.MOVED_OUT, Gio.FileMonitorEvent.RENAMED):
+            return  # CHANGED comes many times while the file is being written, CHANGES_DONE_HINT follows
+        for path in (Path(f.get_path()) for f in (file, other_file) if f):
+            if path.suffix == self.engine.extension:
+                self.engine.page_changed(path)
+            elif event != Gio.FileMonitorEvent.CHANGES_DONE_HINT and self.monitors \
+                    and not Manifest.hidden(path.name) and (path in self.monitors or path.is_dir()):
+                # a folder has been created, moved or removed, we do not know which pages were in there
+                file_cache.invalidate()
+                if self.engine.index:
+                    self.engine.index.invalidate()
+                self.engine.states.invalidate()
+                for folder in [f for f in self.monitors if f == path or path in f.parents]:
+                    self.monitors.pop(folder).cancel()
+                self.monitors_complete = False  # a new folder is watched once the next search has walked it
+
+    def teardown(self):
+        self._cancel_preload()
+        self.preloaded.clear()
+        self.stop_monitoring()
+        self.engine.shutdown()
+
+    # noinspection PyArgumentList,PyUnresolvedReferences
+    @action(_('_Instant search'), accelerator='<ctrl>e', menuhints='tools')  # T: menu item
+    def instant_search(self):
+
+        # init
+        self.last_query = ""  # previous user input
+        self.query_o = None
+        self.original_page = self.window.page.name  # we return here after escape
+        self.original_history = list(self.window.history.uistate["list"])
+        self.selection = None
+        # if not self.plugin.preferences['is_cached']:
+            # reset last search results
+            # self.engine.states.reset()
+        self.menu_page = None
+        self.is_closed = False
+        self.last_page = None
+
+        if not self.titles.is_built:
+            self.titles.build(self._index_titles())
+        # Gtk
+        self.gui = Dialog(self.window, _('Search'), buttons=None, defaultwindowsize=(300, -1))
+        self.gui.resize(300, 100)  # reset size
+        self.input_entry = InputEntry()
+        self.input_entry.connect('key_press_event', self.move)
+        self.input_entry.connect('changed', self.change)  # self.change is needed by GObject or something
+        self.gui.vbox.pack_start(self.input_entry, expand=False, fill=True, padding=0)
+
+        # result list, updated in place, only the visible rows are rendered
+        self.results = Gtk.ListStore(str, str, str)  # markup, page name, snippet markup
+        self.results_view = Gtk.TreeView(model=self.results)
+        self.results_view.set_headers_visible(False)
+        self.results_view.set_enable_search(False)
+        self.results_view.set_can_focus(False)  # keys are handled by the input entry, see move()
+        column = Gtk.TreeViewColumn("", Gtk.CellRendererText(), markup=0)
+        column.set_sizing(Gtk.TreeViewColumnSizing.FIXED)
+        self.results_view.append_column(column)
+        if self.engine.snippets:
+            # the text the page matched with, taken by the fulltext search, tells the results apart without a preview
+            renderer = Gtk.CellRendererText(ellipsize=Pango.EllipsizeMode.END, foreground="gray")
+            column = Gtk.TreeViewColumn("", renderer, markup=2)
+            column.set_sizing(Gtk.TreeViewColumnSizing.FIXED)
+            column.set_fixed_width(300)
+            self.results_view.append_column(column)
+        self.results_view.set_fixed_height_mode(True)  # rows are not measured one by one
+        self.results_view.connect('row-activated', self.on_row_activated)
+        results_container = Gtk.ScrolledWindow()
+        results_container.set_policy(Gtk.PolicyType.NEVER, Gtk.PolicyType.AUTOMATIC)
+        results_container.set_propagate_natural_height(True)
+        results_container.set_max_content_height(max(self.window.get_size()[1] - 150, 100))
+        results_container.set_size_request(300, -1)
+        results_container.add(self.results_view)
+        self.gui.vbox.pack_start(results_container, expand=True, fill=True, padding=0)
+
+        self.metrics_label = Gtk.Label()
+        self.metrics_label.set_xalign(0)
+        self.metrics_label.set_selectable(True)
+        self.metrics_label.set_no_show_all(True)  # shown by F12 only
+        self.gui.vbox.pack_start(self.metrics_label, expand=False, fill=True, padding=0)
+
+        # preview pane, a label for every window of the preview lines rendered, see Preview
+        self.preview_box = Gtk.VBox()
+        self.preview_pane = Gtk.VBox()
+
+        inner_container = Gtk.ScrolledWindow()
+        inner_container.set_policy(Gtk.PolicyType.AUTOMATIC, Gtk.PolicyType.AUTOMATIC)
+        inner_container.add(self.preview_box)
+        # the next lines are rendered when the preview is scrolled near its end or does not fill the pane
+        inner_container.get_vadjustment().connect('value-changed', self.on_preview_scrolled)
+        inner_container.get_vadjustment().connect('changed', self.on_preview_scrolled)
+        h = self.window.pageview.textview.get_allocated_height() - 25
+        inner_container.set_min_content_height(h)
+        inner_container.set_max_content_height(h)
+
+        self.preview_pane.pack_start(inner_container, False, False, 5)
+        self.window.pageview.pack_start(self.preview_pane, False, False, 5)
+
+        # gui geometry
+        self.geometry(init=True)
+
+        self.gui.show_all()
+
+        if self.state:
+            self.prevent_closing = True
+            self.input_entry.set_text(self.state.raw_query)
+            self.input_entry.select_region(0, -1)
+            self.change(None)
+            self.prevent_closing = False
+
+    def geometry(self, init=False, repeat=True, force=False):
+        if repeat and not init:
+            # I do not know how to catch callback when result list's width is final, so we align several times
+            [GObject.timeout_add(x, lambda: self.geometry(repeat=False, force=force)) for x in (30, 50, 70, 400)]
+            # it is not worthy we continue now because often the Gtk redraw is delayed which would mean
+            # the Dialog dimensions change twice in a row
+            return
+
+        px, py = self.window.get_position()
+        pw, ph = self.window.get_size()
+        init_w, init_h = 300, 100
+        if init:
+            x, y = None, None
+            w, h = init_w, init_h
+        else:
+            x, y = self.gui.get_position()
+            w, h = self.gui.get_allocated_width(), self.gui.get_allocated_height()
+        if self.plugin.preferences['position'] == InstantSearchPlugin.POSITION_RIGHT:
+            x2, y2 = px + pw - w, py
+        elif self.plugin.preferences['position'] == InstantSearchPlugin.POSITION_CENTER:
+            x2, y2 = px + (pw / 2) - w / 2, py + (ph / 2) - 250
+        else:
+            raise AttributeError("Instant search: Wrong position preference.")
+
+        if init or x != x2 or force:
+            self.gui.resize(init_w, init_h)
+            self.gui.move(x2, y2)
+
+    def title(self, title=""):
+        self.gui.set_title("Search " + title)
+
+    def change(self, _):  # widget, event,text
+        if self.timeout:
+            GObject.source_remove(self.timeout)
+            self.timeout = None
+        q = self.input_entry.get_text()
+        if q == self.last_query:
+            return
+        if q == State.title_match_char:
+            return
+        if self.state:
+            self._log_metrics(self.state)
+        self.state = self.engine.states.set_current(q)
+
+        if not self.state.is_finished:
+            if self.start_search():
+                self.process_menu()
+        else:  # search completed before
+            # The finished states a changed page might affect are dropped, see Engine.page_changed.
+            self.check_last()
+            self.sout_menu()
+
+        self.last_query = q
+
+    def start_search(self):
+        """ Search string has certainly changed. We search in indexed titles and/or we start fulltext search.
+        :rtype: True if no other search is needed and we may output the menu immediately.
+            
+        """
+
+        query = self.state.query
+        menu = self.state.menu
+
+        if not query:
+            return True
+        if not self.state.first_seen:  # searched before but not finished, ex: cancelled by another query
+            self.state.restart()
+
+        with self.state.metrics.timer("header_search"):
+            SearchController.header_search(query, menu, self.titles)
+
+        if self.state.page_name_only:
+            return True
+        else:
+            if not self.state.previous or len(query) == State.start_search_length:
+                # quickly show page title search results before longer fulltext search is ready
+                # Either there is no previous state – query might have been copied into input
+                # or the query is finally long enough to start fulltext search.
+                # It is handy to show out filtered page names before because
+                # it is often use case to jump to queries matched in page names.
+                self.process_menu(ignore_geometry=True)
+
+            self.title("..")
+            self.timeout = GObject.timeout_add(self.keystroke_delay,
+                                               self.start_zim_search)  # ideal delay between keystrokes
+
+    def start_zim_search(self):
+        """ Starts search for the input. The fulltext search runs in a background thread
+            so that the main loop stays responsive. """
+        self.title("...")
+        if self.timeout:
+            GObject.source_remove(self.timeout)
+            self.timeout = None
+        self.query_o = Query(self.state.query)
+
+        # it should be quicker to find the string, if we provide this subset from last time
+        # (in the case we just added a letter, so that the subset gets smaller)
+        # last_sel = self.selection if self.is_subset and self.state.previous and self.state.previous.is_finished
+        #   else None
+        selection = self.selection = SearchSelection(self.window.notebook)
+        state = self.state  # search runs in a thread, so that self.state might change before search finishes
+
+        # internal search disabled - it was way too slower
+        # selection.search(self.query_o, selection=last_sel, callback=self._search_callback(state))
+        # self._update_results(selection, state, force=True)
+        # self.title("....")
+
+        # fulltext external search, see Engine.scan
+        scan = state.new_scan()  # cancels the scan of this state that might still run
+        paths, complete = self.engine.search_paths(state)
+        first = self._likely_paths(state)
+        if self.search_slice:
+            slices = self.engine.scan_slices(state, scan, paths, complete,
+                                             lambda page, score: self._count_result(selection, state, page, score),
+                                             first, budget=self.search_slice)
+            GLib.idle_add(self._search_slice, selection, state, scan, slices)
+        else:
+            Thread(target=self._search_thread, args=(selection, state, scan, paths, complete, first),
+                   daemon=True).start()
+
+    def _likely_paths(self, state: State) -> List[Path]:
+        """ Files of the pages the user most likely searches for: the title hits and the recently opened pages. """
+        pages = [ZimPath(name) for name in islice(state.menu, self.likely_pages)]
+        pages += islice(self.window.history.get_recent(), self.likely_pages)
+        return [Path(str(self.window.notebook.layout.map_page(page)[0])) for page in pages]
+
+    def _search_thread(self, selection, state: State, scan: Scan, paths: Iterable[Path], complete: bool,
+                       first: List[Path]):
+        """ Runs outside of the main loop. Results are passed to the main loop via GLib.idle_add. """
+        if self.engine.scan(state, scan, paths, complete,
+                            lambda page, score: self._count_result(selection, state, page, score), first):
+            GLib.idle_add(self._search_finished, selection, state, scan)
+
+    def _search_slice(self, selection, state: State, scan: Scan, slices: Generator[None, None, bool]):
+        """ Runs in the main loop for the search_slice time at most, then lets GTK process the events.
+            The results found meanwhile are published by _publish_results. """
+        try:
+            next(slices)
+        except StopIteration as finished:
+            if finished.value:
+                self._search_finished(selection, state, scan)
+            return False
+        return True  # continue with the next slice
+
+    def _search_finished(self, selection, state: State, scan: Scan):
+        if scan is not state.scan:  # the state has been searched again meanwhile
+            return False
+        self._update_results(selection, state, force=True)
+        state.scan_finished(scan)
+
+        if state == self.state and not self.is_closed:
+            self.check_last()
+
+        self.process_menu(state=state)
+        if not self.is_closed:
+            self.title()
+        self.start_monitoring()
+        return False  # do not repeat the idle callback
+
+    def _count_result(self, selection, state: State, page: ZimPath, score: int):
+        """ Called from the search thread. """
+        # noinspection PyProtectedMember
+        selection._count_score(page, score)
+        self._publish_results(selection, state)
+
+    def check_last(self):
+        """ opens the page if there is only one option in the menu """
+        if len(self.state.menu) == 1 and self.plugin.preferences['open_when_unique']:
+            self._open_page(ZimPath(list(self.state.menu)[0]), exclude_from_history=False)
+            if not self.prevent_closing:
+                self.close()
+        elif not len(self.state.menu):
+            self._open_original()
+
+    def _search_callback(self, state):
+        def _(results, _path):
+            if results is not None:
+                # we finish the search even if another search is running.
+                # If returned False, the search would be cancelled
+                self._update_results(results, state)
+            while Gtk.events_pending():
+                Gtk.main_iteration()
+            return True
+
+        return _
+
+    def _publish_results(self, selection, state: State):
+        """ Called from the search thread. Schedules the results update unless there is one waiting already. """
+        if not self._update_pending:
+            self._update_pending = True
+            GLib.idle_add(self._idle_update_results, selection, state)
+
+    def _idle_update_results(self, selection, state: State):
+        self._update_pending = False
+        self._update_results(selection, state)
+        return False  # do not repeat the idle callback
+
+    def _update_results(self, results, state: State, force=False):
+        """
+        This method may run many times, due to the _update_results, which are updated many times,
+         the results are appearing one by one. However, if called earlier than 0.2 s, ignored.
+
+        Measures:
+            If every callback would be counted, it takes 3500 ms to build a result set.
+            If callbacks earlier than 0.6 s -> 2300 ms, 0.3 -> 2600 ms, 0.1 -> 2800 ms.
+        """
+        if not force and time() < self._last_update + 0.2:  # if update callback called earlier than 200 ms, ignore
+            return
+        self._last_update = time()
+
+        # the search thread may add scores meanwhile, work on a copy
+        if state.add_scores({option.name: score for option, score in dict(results.scores).items()}):
+            self.process_menu(state=state, sort=False)  # we added a page
+
+    def process_menu(self, state=None, sort=True, ignore_geometry=False):
+        """ Sort menu and generate items and sout menu. """
+        if state is None:
+            state = self.state
+        state.sort_items(sort)
+        if state == self.state and not self.is_closed:
+            self.sout_menu(ignore_geometry=ignore_geometry)
+
+    def sout_menu(self, display_immediately=False, caret_move=None, ignore_geometry=False):
+        """ Displays menu and handles caret position. """
+        if self.timeout_open_page:
+            GObject.source_remove(self.timeout_open_page)
+            self.timeout_open_page = None
+        if self.timeout_open_page_preview:
+            GObject.source_remove(self.timeout_open_page_preview)
+            self.timeout_open_page_preview = None
+
+        # caret:
+        #   by default stays at position 0
+        #   If moved to a page, it keeps the page.
+        #   If moved back to position 0, stays there.
+        if caret_move is not None:
+            if caret_move == 0:
+                self.caret.pos = 0
+            else:
+                self.caret.pos += caret_move
+            self.caret.stick = self.caret.pos != 0
+        elif self.state.items and self.caret.stick:
+            # identify current caret position, depending on the text
+            self.caret.pos = next((i for i, item in enumerate(self.state.items) if item.path == self.caret.text), 0)
+        if caret_move not in (None, float("inf")) and self.caret.pos >= len(self.state.items) and self.state.hidden:
+            # the caret moved past the results shown, show more of them
+            self.state.show_more(self.caret.pos + 1)
+        # treat possible caret deflection
+        if self.caret.pos < 0:
+            # place the caret to the beginning or the end of list
+            self.caret.pos = 0
+        elif self.caret.pos >= len(self.state.items):
+            self.caret.pos = 0 if caret_move == 1 else len(self.state.items) - 1
+
+        start = perf_counter()
+        rows = []
+        for i, page in enumerate(self.state.items):
+            score = page.score + page.page_score
+            page.last_order = i
+            pieces = [GLib.markup_escape_text(piece) for piece in page.path.split(":")]
+            pieces[-1] = f"<b>{pieces[-1]}</b>"
+            snippet = self.state.snippet(page.path)
+            rows.append([f'{":".join(pieces)} ({score})', page.path,
+                         f"<small>{markup_highlight(snippet, self.state.query)}</small>" if snippet else ""])
+        if self.state.hidden:
+            rows.append([f"<i>{self.state.hidden} more</i>", "", ""])
+        elif not rows and self.state.is_finished:
+            rows.append(["No result", "", ""])
+        if self.state.items:
+            self.caret.text = self.state.items[self.caret.pos].path  # caret is at this position
+
+        # update the rows changed only
+        rows_before = len(self.results)
+        for i, row in enumerate(rows):
+            if i >= len(self.results):
+                self.results.append(row)
+            elif list(self.results[i]) != row:
+                self.results[i] = row
+        while len(self.results) > len(rows):
+            self.results.remove(self.results.get_iter(len(rows)))
+        if self.state.items:
+            caret = Gtk.TreePath(self.caret.pos)
+            self.results_view.get_selection().select_path(caret)
+            self.results_view.scroll_to_cell(caret, None, False, 0, 0)
+        else:
+            self.results_view.get_selection().unselect_all()
+        self.state.metrics["render_s"] += perf_counter() - start
+        self._update_metrics()
+
+        self.menu_page = ZimPath(self.caret.text if len(self.state.items) else self.original_page)
+
+        if not display_immediately:
+            if self.plugin.preferences['preview_mode'] != InstantSearchPlugin.PREVIEW_ONLY:
+                self.timeout_open_page = GObject.timeout_add(self.keystroke_delay_open, self._open_page,
+                                                             self.menu_page)  # ideal delay between keystrokes
+            if self.plugin.preferences['preview_mode'] != InstantSearchPlugin.FULL_ONLY:
+                self.timeout_open_page_preview = GObject.timeout_add(self.keystroke_delay, self._open_page_preview,
+                                                                     self.menu_page)  # ideal delay between keystrokes
+        else:
+            self._open_page(self.menu_page)
+        if self.plugin.preferences['preload_pages']:
+            self._schedule_preload()
+        # we force here geometry to redraw because often we end up with "No result" page that is very tall
+        # because of a many records just hidden
+        if not ignore_geometry and len(rows) != rows_before:
+            self.geometry(force=True)
+
+    def _schedule_preload(self):
+        """ When the caret rests, parse the pages likely to be opened next: the one under the caret,
+            its neighbours and the top-ranked result. So that opening them does not stutter. """
+        if self.state.scan and not self.state.is_finished:  # the results are still coming, the pages would change
+            self._cancel_preload()
+            return
+        items, pos = self.state.items, self.caret.pos
+        pages = list(dict.fromkeys(items[i].path for i in (pos, pos + 1, pos - 1, 0) if 0 <= i < len(items)))
+        if self.timeout_preload and pages == self.preload_scheduled:  # the menu shown again, the pages are the same
+            return
+        self._cancel_preload()
+        self.preload_scheduled = pages
+        self.timeout_preload = GObject.timeout_add(self.keystroke_delay, self._start_preload, list(pages))
+
+    def _cancel_preload(self):
+        if self.timeout_preload:
+            GObject.source_remove(self.timeout_preload)
+            self.timeout_preload = None
+
+    def _start_preload(self, pages: List[ZimPathStr]):
+        # a page at once in the idle time, the events (typed letters) are handled between them
+        self.timeout_preload = GLib.idle_add(self._preload, pages, priority=GLib.PRIORITY_LOW)
+        return False  # do not repeat the timeout
+
+    def _preload(self, pages: List[ZimPathStr]):
+        """ Parse the next page into the Zim page cache. Runs in the main loop: the Zim pages are not thread-safe,
+            a page opened in the editor meanwhile must not get a parse tree from a worker thread.
+            The parsing cannot be interrupted, only the pages parsed quickly are preloaded.
+        """
+        if Gtk.events_pending():  # ex: a letter typed, wait for the next idle time
+            return True
+        while pages and not self.is_closed:
+            name = pages.pop(0)
+            if name == self.last_page:  # opened already
+                continue
+            try:
+                path = self.window.notebook.layout.map_page(ZimPath(name))[0]
+                if os.path.getsize(str(path)) > self.preload_max_size:
+                    continue
+                page = self.window.notebook.get_page(ZimPath(name))
+                if not page.hascontent:
+                    continue
+                # cached by the page (quick if parsed already), Zim drops it when getting the page if the file changed
+                page.get_parsetree()
+            except Exception as err:  # best effort, the page will be parsed when opened
+                logger.debug("[Instantsearch] Page %s not parsed in advance: %s", name, err)
+                continue
+            self.preloaded[name] = page
+            self.preloaded.move_to_end(name)
+            while len(self.preloaded) > self.preloaded_kept:
+                self.preloaded.popitem(last=False)
+            if pages:
+                return True  # the next page in the next idle time
+            break
+        self.timeout_preload = None
+        return False
+
+    def on_row_activated(self, view, path, column):
+        """ Open the result clicked. """
+        i = path.get_indices()[0]
+        if i < len(self.state.items):
+            self._open_page(ZimPath(self.state.items[i].path), exclude_from_history=False)
+            self.close()
+
+    def move(self, widget, event):
+        """ Move caret up and down. Enter to confirm, Esc closes search."""
+        key_name = Gdk.keyval_name(event.keyval)
+
+        # handle basic caret movement
+        moves = {"Up": -1, "ISO_Left_Tab": -1, "Down": 1, "Tab": 1, "Page_Up": -10, "Page_Down": 10}
+        if key_name in moves:
+            self.sout_menu(display_immediately=False, caret_move=moves[key_name])
+        elif key_name in ("Home", "End"):
+            if event.state & Gdk.ModifierType.CONTROL_MASK or event.state & Gdk.ModifierType.SHIFT_MASK:
+                # Ctrl/Shift+Home jumps to the query input text start
+                return
+            if key_name == "Home":  # Home jumps at the result list start
+                self.sout_menu(display_immediately=False, caret_move=0)
+                widget.emit_stop_by_name("key-press-event")
+            else:
+                self.sout_menu(display_immediately=False, caret_move=float("inf"))
+                widget.emit_stop_by_name("key-press-event")
+
+        elif key_name == "F12":  # debug pane with the metrics of the search
+            self.show_metrics = not self.show_metrics
+            self._update_metrics()
+
+        # confirm or cancel
+        elif key_name == "KP_Enter" or key_name == "Return":
+            self._open_page(self.menu_page, exclude_from_history=False)
+            self.close()
+        elif key_name == "Escape":
+            self._open_original()
+            self.is_closed = True  # few more timeouts are on the way probably
+            self.close()
+
+        return
+
+    def close(self):
+        """ Safely (closes gets called when hit Enter) """
+        if not self.is_closed:  # if hit Esc, GTK has already emitted close itself
+            self.is_closed = True
+            self.gui.emit("close")
+        self._cancel_preload()
+
+        if self.state:
+            self._log_metrics(self.state)
+
+        # remove preview pane and show current text editor
+        self._hide_preview()
+        self.preview_pane.destroy()
+        Preview.release_pending()
+        if self.engine.store:
+            self.engine.store.flush()
+        if not self.monitors_complete:  # until next search, pages might change
+            file_cache.invalidate()
+            if self.engine.index:
+                self.engine.index.invalidate()
+
+    def _open_original(self):
+        self._open_page(ZimPath(self.original_page))
+        # we already have HistoryPath objects in the self.original_history, we cannot add them in the constructor
+        # XX I do not know what is that good for
+        hl = HistoryList([])
+        hl.extend(self.original_history)
+        self.window.history.uistate["list"] = hl
+
+    # noinspection PyProtectedMember
+    def _open_page(self, page, exclude_from_history=True):
+        """ Open page and highlight matches """
+        self._hide_preview()
+        if self.timeout_open_page:  # no delayed page will be open
+            GObject.source_remove(self.timeout_open_page)
+            self.timeout_open_page = None
+        if self.timeout_open_page_preview:  # no delayed preview page will be open
+            GObject.source_remove(self.timeout_open_page_preview)
+            self.timeout_open_page_preview = None
+
+        # open page
+        if page and page.name and page.name != self.last_page:
+            self.last_page = page.name
+            self.window.navigation.open_page(page)
+            if exclude_from_history and list(self.window.history._history)[-1:][0].name != self.original_page:
+                # there is no public API, so lets use protected _history instead
+                self.window.history._history.pop()
+                self.window.history._current = len(self.window.history._history) - 1
+        if not exclude_from_history and self.window.history.get_current().name is not page.name:
+            # we insert the page to the history because it was likely to be just visited and excluded
+            self.window.history.append(page)
+
+        # Popup find dialog with same query
+        if self.query_o:  # and self.query_o.simple_match:
+            string = self.state.query
+            string = string.strip('*')  # support partial matches
+            if self.plugin.preferences['highlight_search']:
+                # highlight all the query terms at once, any of them matches the regex
+                terms = sorted({re.escape(q) for q in string.split(" ") if q}, key=len, reverse=True)
+                if terms:
+                    self.window.pageview.show_find("|".join(terms), flags=FIND_REGEX, highlight=True)
+
+    def _add_preview_label(self, markup: str):
+        label = Gtk.Label()
+        # not sure if this has effect, longer lines without spaces still make window inflate
+        label.set_line_wrap(True)
+        label.set_xalign(0)  # align to the left
+        label.set_valign(Gtk.Align.START)  # align to the top
+        label.set_markup(markup)
+        label.show()
+        self.preview_box.pack_start(label, False, False, 0)
+
+    def on_preview_scrolled(self, adjustment):
+        """ Render the next window of the preview lines if the preview is scrolled near its end. """
+        if self.preview and not self.preview.finished \
+                and adjustment.get_value() + 2 * adjustment.get_page_size() >= adjustment.get_upper():
+            markup = self.preview.render()
+            if markup is not None:
+                self._add_preview_label(markup)
+
+    def _update_metrics(self):
+        """ Show the metrics of the current search in the debug pane, if toggled. """
+        if not self.metrics_label:
+            return
+        if self.show_metrics and self.state and not self.is_closed:
+            self.metrics_label.set_text(f"query: {self.state.raw_query}\n"
+                                        f"titles: {len(self.titles.titles)} ({self.titles.build_s * 1000:g} ms)\n"
+                                        f"states: {dict(self.engine.states.stats)}\n"
+                                        f"cached pages: {len(file_cache)} ({file_cache.size} B)\n"
+                                        + self.state.metrics.format())
+            self.metrics_label.show()
+        else:
+            self.metrics_label.hide()
+
+    def _log_metrics(self, state: State):
+        """ Log the metrics of the search, optionally append them to the JSON lines file.
+            Then they start over, the next time the query is shown only the new work is counted. """
+        if not state.metrics:
+            return
+        line = {"date": strftime("%Y-%m-%d %H:%M:%S"), "query": state.raw_query, "results": state.count,
+                "finished": state.is_finished, "titles": len(self.titles.titles),
+                "titles_build_ms": round(self.titles.build_s * 1000, 3), **state.metrics.as_dict()}
+        state.metrics.clear()
+        logger.debug("[Instantsearch] Search metrics: %s", line)
+        if self.plugin.preferences['metrics_log']:
+            try:
+                with open(os.path.expanduser(self.plugin.preferences['metrics_log']), "a", encoding="utf-8") as f:
+                    f.write(json.dumps(line, ensure_ascii=False) + "\n")
+            except OSError as err:
+                logger.warning("[Instantsearch] Metrics not logged: %s", err)
+
+    def _hide_preview(self):
+        self.preview_pane.hide()
+        # noinspection PyProtectedMember
+        self.window.pageview._hack_hbox.show()
+    
+    def _path2zim(self, path: Path) -> ZimPath:
+        return self.window.notebook.layout.map_file(LocalFile(str(path)))[0]
+
+    def _index_titles(self, start=""):
+        """ Page titles from the notebook index. """
+        for s in self.window.notebook.pages.list_pages(ZimPath(start or ":")):
+            start2 = (start + ":" if start else "") + s.basename
+            yield start2
+            yield from self._index_titles(start2)
+
+    def _open_page_preview(self, page: ZimPath):
+        """ Open preview which is far faster then loading and
+         building big parse trees into text editor buffer when opening page. """
+        # note: if the dialog is already closed, we do not want a preview to open, but page still can be open
+        # (ex: after hitting Enter the dialog can close before opening the page)
+
+        if self.timeout_open_page_preview:
+            # no delayed preview page will be open, however self.timeout_open_page might be still running
+            GObject.source_remove(self.timeout_open_page_preview)
+            self.timeout_open_page_preview = None
+
+        # it does not pose a problem if we re-load preview on the same page;
+        # the query text might got another letter to highlight
+        if page and not self.is_closed:
+            # show preview pane and hide current text editor
+            self.last_page_preview = page.name
+
+            start = perf_counter()
+            local_file: File = self.window.notebook.layout.map_page(page)[0]
+            cached = file_cache.get(Path(str(local_file)), self.engine.path2zim)
+            if cached:  # rendered before if the page and the query are the same
+                # jump to the lines the fulltext search has found the query in
+                preview = Preview.get(cached, self.state.query, self.plugin.preferences["preview_short"],
+                                      self.state.match_offsets(Path(str(local_file))))
+            else:  # page has not been created yet
+                preview = Preview(f"page {page} has no content", self.state.query)
+
+            # the file length is very small, prefer to not use preview here
+            if self.plugin.preferences['preview_mode'] != InstantSearchPlugin.PREVIEW_ONLY and preview.lines < 50:
+                return self._open_page(page, exclude_from_history=True)
+            self.preview = preview
+            for label in self.preview_box.get_children():
+                label.destroy()
+            if not preview.windows:
+                preview.render()  # the first window, the next ones when the preview is scrolled
+            for markup in preview.windows:
+                self._add_preview_label(markup)
+            self.state.metrics["preview_s"] += perf_counter() - start
+            self._update_metrics()
+
+            # shows GUI (hidden in self._hide_preview()
+            self.preview_pane.show_all()
+            # noinspection PyProtectedMember
+            self.window.pageview._hack_hbox.hide()
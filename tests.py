@@ -1,11 +1,16 @@
+import os
+import re
+from array import array
 from collections import defaultdict
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import sleep
+from types import SimpleNamespace
 from unittest import TestCase, main
 
-import gi
-
-gi.require_version('Gtk', '3.0')
-
-from instantsearch import SearchController, _MenuItem
+from _instantsearch_engine import (Engine, FileCache, PageStore, PageText, Preview, QueryPlan, SearchController, State,
+                                  StateCache, TitleCache, TrigramIndex, _FileCache, _MenuItem, file_cache,
+                                  get_preview_text)
 
 cached_titles = [
     'Journal',
@@ -31,6 +36,472 @@ class TestSearch(TestCase):
         self._search("foo", ['Journal:foo', 'Journal:foo:bar', 'Journal:foo:bar:fourth', 'foo test', 'foo (test)'])
         self._search("tes", ['test', 'Journal:test', 'foo test', 'foo (test)'])
 
+    def test_title_cache(self):
+        """ Searching through the title cache candidates gives the same result as looping all the titles. """
+        titles = TitleCache()
+        [titles.add(title) for title in cached_titles]
+        for query in ("foo", "tes", "st", "j", "ou", "journal:f", "o b", "2021 12", "fourth"):
+            expected, menu = defaultdict(_MenuItem), defaultdict(_MenuItem)
+            SearchController.header_search(query, expected, sorted(cached_titles))
+            SearchController.header_search(query, menu, titles)
+            scores = lambda m: [(p, i.page_score, i.page_highlight, i.page_insufficient) for p, i in m.items()]
+            self.assertListEqual(scores(expected), scores(menu))
+
+    def test_query_plan(self):
+        """ The plan is built once per query, its regexes are compiled when needed. """
+        plan = QueryPlan.get("foo te")
+        self.assertIs(plan, QueryPlan.get("foo te"))
+        self.assertTrue(plan.plain)
+        self._search("foo te", ['foo test', 'foo (test)'])
+        self.assertIsNotNone(plan._title)
+        self.assertIsNone(plan._fulltext)
+        self.assertFalse(QueryPlan.get("foo ").plain)
+
+    def test_snippet(self):
+        """ The snippet is a line around the best match, the whole query preferred to a term, the text to the title. """
+        contents = ("\n\n====== Foo bar title ======\nbar only\n"
+                    + "lorem ipsum " * 10 + "foo **bar** baz " + "dolor " * 20)
+
+        def snippet(query):
+            page, offsets = _FileCache("page", contents, PageText(contents), 0, 0), array("i")
+            SearchController.fulltext_score(query, "page", page, offsets)
+            return SearchController.snippet(query, page, offsets)
+
+        self.assertEqual("bar only", snippet("bar"))
+        self.assertEqual("…lorem ipsum lorem ipsum foo **bar** baz dolor dolor dolor dolor dolor dolor…",
+                         snippet("foo bar"))
+        self.assertIn("ipsum foo **bar** baz", snippet("foo"))  # not the title
+        self.assertEqual("====== Foo bar title ======", snippet("title"))  # in the title only
+        self.assertEqual("", snippet("zzz"))
+
+
+class TestTitleCache(TestCase):
+    def test_update(self):
+        titles = TitleCache()
+        [titles.add(title) for title in reversed(cached_titles)]
+        titles.add("test")
+        titles.remove("Journal:foo:bar")
+        titles.remove("missing")
+        self.assertListEqual(sorted(set(cached_titles) - {"Journal:foo:bar"}), titles.titles)
+
+
+class TestFileCache(TestCase):
+    def test_revalidation(self):
+        with TemporaryDirectory() as d:
+            path = Path(d, "page.txt")
+            path.write_text("Content-Type: text/x-zim-wiki\nWiki-Format: zim 0.6\n\nfoo")
+            cache = FileCache()
+            self.assertEqual("\n\nfoo", cache.get(path, str).contents)
+
+            # not re-read during the same dialog session
+            path.write_text("bar")
+            os.utime(path, ns=(0, 0))
+            self.assertEqual("\n\nfoo", cache.get(path, str).contents)
+            # re-read when mtime changed
+            cache.invalidate()
+            self.assertEqual("bar", cache.get(path, str).contents)
+
+            path.unlink()
+            cache.invalidate()
+            self.assertIsNone(cache.get(path, str))
+            self.assertNotIn(path, cache)
+
+    def test_eviction(self):
+        with TemporaryDirectory() as d:
+            paths = [Path(d, f"{i}.txt") for i in range(3)]
+            [p.write_text("12345") for p in paths]
+            cache = FileCache()
+            cache.get(paths[0], str)
+            cache.max_size = page_size = cache.size
+            cache.max_size *= 2
+            [cache.get(p, str) for p in paths]
+            self.assertNotIn(paths[0], cache)
+            self.assertIn(paths[2], cache)
+            self.assertEqual(page_size * 2, cache.size)
+
+    def test_store(self):
+        """ The pages read in a previous run are loaded from the store, unless their file has changed. """
+        with TemporaryDirectory() as d:
+            paths = [Path(d, f"{i}.txt") for i in range(3)]
+            [p.write_text(f"foo [[link]] {i}\n== heading ==") for i, p in enumerate(paths)]
+            cache = FileCache()
+            cache.stores[Path(d)] = store = PageStore(Path(d, "cache", "pages.sqlite"))
+            [cache.get(p, str) for p in paths]
+            store.close()
+
+            paths[1].write_text("changed")
+            paths[2].unlink()
+            cache = FileCache()
+            cache.stores[Path(d)] = store = PageStore(Path(d, "cache", "pages.sqlite"))
+            cache.load(store, str)
+            self.assertEqual(3, len(cache))
+            self.assertEqual("foo [[link]] 0\n== heading ==", cache.get(paths[0], str).contents)
+            parsed, loaded = PageText(cache.get(paths[0], str).contents), cache.get(paths[0], str).text
+            self.assertListEqual([getattr(parsed, s) for s in PageText.__slots__],
+                                 [getattr(loaded, s) for s in PageText.__slots__])
+            self.assertEqual("changed", cache.get(paths[1], str).contents)
+            self.assertIsNone(cache.get(paths[2], str))
+            self.assertEqual(2, len(list(store.pages())))
+
+    def test_notebook_stores(self):
+        """ Every notebook has its own store, the pages of the files removed meanwhile are dropped from it. """
+        with TemporaryDirectory() as d:
+            for notebook in ("a", "b"):
+                for name in ("foo", "bar"):
+                    Path(d, notebook, name + ".txt").parent.mkdir(exist_ok=True)
+                    Path(d, notebook, name + ".txt").write_text("foo")
+            stored = lambda notebook: sorted(path.stem for path, *_ in PageStore(Path(d, notebook + ".sqlite")).pages())
+            engines = [Engine(Path(d, notebook), store=PageStore(Path(d, notebook + ".sqlite"))) for notebook in "ab"]
+            for engine in engines:
+                engine.search("foo")
+            engines[0].shutdown()
+            self.assertNotIn(Path(d, "a"), file_cache.stores)
+            self.assertListEqual(["bar", "foo"], stored("a"))
+            engines[1].shutdown()
+            self.assertListEqual(["bar", "foo"], stored("b"))
+            self.assertDictEqual({}, file_cache.stores)
+
+            Path(d, "a", "bar.txt").unlink()
+            engine = Engine(Path(d, "a"), store=PageStore(Path(d, "a.sqlite")))
+            list(engine.paths())
+            engine.shutdown()
+            self.assertListEqual(["foo"], stored("a"))
+
+
+class TestTrigramIndex(TestCase):
+    def test_filter(self):
+        with TemporaryDirectory() as d:
+            pages = {"bold": "economi**cal** topic", "link": "economi[[inserted link]]cal",
+                     "url": "[[http://economical.example.com|link]]", "other": "economy", "economical": "nothing"}
+            paths = []
+            for name, text in pages.items():
+                paths.append(Path(d, name + ".txt"))
+                paths[-1].write_text(text)
+            index = TrigramIndex(Path(d, "cache", "index.sqlite"))
+            index.update(paths, lambda p: p.stem, complete=True)
+            found = lambda query: sorted(p.stem for p in index.filter(paths, query))
+            self.assertListEqual(["bold", "economical", "link", "url"], found("economical"))
+            self.assertListEqual(["bold"], found("economical topic"))
+            self.assertListEqual(["bold", "economical", "link", "other", "url"], found("ec"))
+
+
+class TestPageText(TestCase):
+    contents = "\n\n====== Economi**cal** ======\neconomi[[inserted link]]cal, //economical// ECONOMICAL\n== eco =="
+
+    def test_normalized(self):
+        text = PageText(self.contents)
+        self.assertEqual("\n\n====== economical ======\neconomical, economical economical\n== eco ==", text.body)
+        self.assertEqual("inserted link", text.links)
+        self.assertEqual(self.contents.index("ECONOMICAL"), text.offset(text.body.rfind("economical")))
+        self.assertEqual(self.contents.index("cal, "), text.offset(text.body.index("cal, ")))
+
+    def test_score(self):
+        # the same score as the regex on the text without links
+        body = re.sub(r"\[\[(.*?)\]\]", "", self.contents)
+        text = PageText(self.contents)
+        for q in ("economical", "eco", "cal", "="):
+            regex = re.compile("(\n=+ .*)?" + r"[*/'_~]*".join(re.escape(c) for c in q), re.IGNORECASE)
+            self.assertEqual(sum(len(m.group(1)) * 3 if m.group(1) else 1 for m in regex.finditer(body)),
+                             text.score(q), q)
+
+
+class TestState(TestCase):
+    def setUp(self):
+        State.title_match_char, State.start_search_length = "!", 3
+        self.states = StateCache()
+
+    def test_eviction(self):
+        self.states.max_states = 3
+        for query in ("foo", "fooo", "bar", "baz", "foooo"):
+            self.states.set_current(query)
+        # "fooo" is kept as the prefix of the current query, "foo" and "bar" were least recently used
+        self.assertListEqual(["fooo", "baz", "foooo"], list(self.states))
+        self.assertIs(self.states.get("fooo"), self.states.get("foooo").previous)
+        self.states.set_current("baz")
+        self.assertEqual(1, self.states.stats["hits"])
+        self.assertEqual(2, self.states.stats["evictions"])
+
+    def test_cancelled_scan(self):
+        state = self.states.set_current("linu")
+        scan = state.new_scan()
+        scan.matching_files.append(Path("a"))
+        self.states.set_current("linux")
+        self.assertTrue(scan.cancelled)
+        self.assertIsNone(state.candidate_paths)
+
+        # partial results of the cancelled scan together with the unscanned paths are usable
+        state.scan_cancelled(scan, [Path("b")])
+        self.assertListEqual([Path("a"), Path("b")], self.states.get("linux").previous.candidate_paths)
+
+        # results of an older scan of the same state are ignored
+        state.new_scan()
+        state.scan_cancelled(scan, [])
+        self.assertIsNone(state.candidate_paths)
+
+    def test_derived_menu(self):
+        """ A narrower query gets its own copies of the previous items, the scores are counted again. """
+        state = self.states.set_current("linu")
+        SearchController.header_search("linu", state.menu, ["Linux", "Linux:Foo", "Unix"])
+        state.menu["Linux"].score = 5
+        state.menu["Linux"].last_order = 1
+
+        derived = self.states.set_current("linux")
+        self.assertIs(state, derived.previous)
+        self.assertListEqual(["Linux", "Linux:Foo"], list(derived.menu))
+        item = derived.menu["Linux"]
+        self.assertIsNot(state.menu["Linux"], item)
+        self.assertEqual((0, 1, "Linux"), (item.score, item.last_order, item.path))
+        self.assertEqual(5, state.menu["Linux"].score)
+
+        derived.menu.pop("Linux:Foo")
+        self.assertIn("Linux:Foo", state.menu)
+        self.assertListEqual([item], list(derived.menu.values()))
+
+    def test_show_more(self):
+        state = self.states.set_current("!tes")
+        SearchController.header_search("tes", state.menu, ["test", "Journal:test", "foo test", "bar test", "x"])
+        state.limit = 2
+        state.sort_items()
+        self.assertListEqual(["test", "foo test"], [item.path for item in state.items])
+        self.assertEqual(2, state.hidden)
+        state.show_more(3)
+        self.assertListEqual(["test", "foo test", "bar test", "Journal:test"], [item.path for item in state.items])
+        self.assertEqual(0, state.hidden)
+
+
+class TestStreaming(TestCase):
+    def test_file_score(self):
+        stream_size, stream_chunk = SearchController.stream_size, SearchController.stream_chunk
+        SearchController.stream_size, SearchController.stream_chunk = 10, 7
+        try:
+            with TemporaryDirectory() as d:
+                path = Path(d, "page.txt")
+                path.write_text("lorem ipsum\n" * 10 + "economi**cal** [[ab]]\n[[cd]]")
+                cache = FileCache()
+                file_cache.clear()
+                # not read whole if the contents do not match
+                self.assertIsNone(SearchController.file_score("economy", path, str))
+                self.assertEqual(("page", 0, False), SearchController.file_score("page", path, lambda _: "page"))
+                self.assertNotIn(path, file_cache)
+                # the same score as when the whole file is read
+                for query in ("economical", "abcd", "lorem economical"):
+                    expected = SearchController.fulltext_score(query, str(path), cache.get(path, str))
+                    self.assertEqual((str(path), *expected), SearchController.file_score(query, path, str))
+                self.assertIn(path, file_cache)
+        finally:
+            SearchController.stream_size, SearchController.stream_chunk = stream_size, stream_chunk
+
+
+class TestEngine(TestCase):
+    def setUp(self):
+        State.title_match_char, State.start_search_length = "!", 3
+
+    def test_search(self):
+        with TemporaryDirectory() as d:
+            pages = {"Linux": "linux is an os\n== Foo ==\nfoo bar", "Linux/Foo": "nothing here bar",
+                     "Journal/2021": "economi**cal** stuff [[Linux]]", "Other_page": "economi[[x]]cal"}
+            for name, text in pages.items():
+                path = Path(d, name + ".txt")
+                path.parent.mkdir(exist_ok=True)
+                path.write_text("Content-Type: text/x-zim-wiki\nWiki-Format: zim 0.6\n\n" + text)
+            engine = Engine(Path(d))
+            search = lambda query: [(item.path, item.score + item.page_score) for item in engine.search(query)]
+            self.assertListEqual([("Other page", 1), ("Journal:2021", 1)], search("economical"))
+            self.assertListEqual([("Linux", 2), ("Linux:Foo", 1)], search("linux b"))
+            self.assertListEqual([("Other page", 10)], search("!oth"))
+
+    def test_notebooks(self):
+        """ Every notebook has its own results cache. """
+        with TemporaryDirectory() as d:
+            for name in ("a/alpha", "b/beta"):
+                Path(d, name + ".txt").parent.mkdir(exist_ok=True)
+                Path(d, name + ".txt").write_text("economical " + name)
+            a, b = Engine(Path(d, "a")), Engine(Path(d, "b"))
+            self.assertListEqual(["alpha"], [item.path for item in a.search("economical")])
+            self.assertListEqual(["beta"], [item.path for item in b.search("economical")])
+            self.assertListEqual(["beta"], [item.path for item in b.search("economical b")])
+
+    def test_cancelled_search(self):
+        """ Coming back to a query whose search has been cancelled, the title scores are not counted twice. """
+        with TemporaryDirectory() as d:
+            for name, text in {"Linux": "linux is an os", "Linux/Foo": "nothing", "Unix": "linux like"}.items():
+                Path(d, name + ".txt").parent.mkdir(exist_ok=True)
+                Path(d, name + ".txt").write_text(text)
+            engine = Engine(Path(d))
+            search = lambda query: [(item.path, item.score + item.page_score) for item in engine.search(query)]
+            expected = search("linux")
+
+            engine.states.reset()
+            state = engine.states.set_current("linux")
+            SearchController.header_search("linux", state.menu, engine.titles)
+            state.new_scan()
+            search("linuxx")  # cancels the scan
+            self.assertFalse(state.is_finished)
+            self.assertListEqual(expected, search("linux"))
+
+    def test_parallel_search(self):
+        """ A page is always searched by the same worker process, that does not use it once changed. """
+        with TemporaryDirectory() as d:
+            for i in range(8):
+                Path(d, f"page{i}.txt").write_text("alphabet" if i < 2 else "nothing")
+            serial, engine = Engine(Path(d)), Engine(Path(d), processes=2, parallel_threshold=0)
+            try:
+                search = lambda query: sorted(item.path for item in engine.search(query))
+                self.assertListEqual(["page0", "page1"], search("alphabet"))
+                self.assertEqual(2, len(engine._pools))
+                search("nothing")
+                self.assertEqual((8, 0), (engine.states.get("nothing").metrics["cache_hits"],
+                                          engine.states.get("nothing").metrics["cache_misses"]))
+
+                Path(d, "page3.txt").write_text("alphabet")
+                engine.page_changed(Path(d, "page3.txt"))
+                self.assertListEqual(["page0", "page1", "page3"], search("alphabet"))
+                self.assertListEqual(search("alphabet"), sorted(item.path for item in serial.search("alphabet")))
+            finally:
+                engine.shutdown()
+
+    def test_metrics(self):
+        """ The search counts its phases. """
+        with TemporaryDirectory() as d:
+            for name, text in {"linux": "linux is an os", "foo": "foo bar"}.items():
+                Path(d, name + ".txt").write_text(text)
+            file_cache.clear()
+            engine = Engine(Path(d))
+            engine.search("linux")
+            metrics = engine.states.get("linux").metrics
+            self.assertEqual(2, metrics["files"])
+            self.assertEqual(2, metrics["cache_misses"])
+            self.assertEqual(len("linux is an os") + len("foo bar"), metrics["bytes_read"])
+            phases = ("header_search", "scan", "read", "score", "sort")
+            self.assertTrue(all(metrics[phase + "_s"] > 0 for phase in phases))
+            self.assertEqual(round(metrics["scan_s"] * 1000, 3), metrics.as_dict()["scan_ms"])
+
+            engine.search("linux os")
+            self.assertEqual(1, engine.states.get("linux os").metrics["cache_hits"])  # narrowed to the matching page
+
+    def test_manifest(self):
+        """ Only the changed folders are read again, the same files are found as by rglob, except the hidden ones. """
+        with TemporaryDirectory() as d:
+            for name in ("a.txt", "b.txt", "b/c.txt", "b/d.png", "e.txt/f.txt", ".zim/g.txt"):
+                Path(d, name).parent.mkdir(exist_ok=True)
+                Path(d, name).write_text("foo")
+            engine = Engine(Path(d))
+            [os.utime(folder, ns=(0, 0)) for folder in (d, Path(d, "b"), Path(d, "e.txt"))]
+            self.assertListEqual(sorted(p for p in Path(d).rglob("*.txt") if p.is_file() and ".zim" not in p.parts),
+                                 sorted(engine.paths()))
+            self.assertEqual("b:c", engine.path2zim(Path(d, "b", "c.txt")))
+
+            Path(d, "b", "c.txt").rename(Path(d, "b", "g.txt"))
+            Path(d, "h.txt").write_text("foo")
+            os.utime(Path(d, "e.txt"), ns=(0, 0))
+            Path(d, "e.txt", "f.txt").unlink()
+            os.utime(Path(d, "e.txt"), ns=(0, 0))  # not read again, folder mtime unchanged
+            expected = ("a.txt", "b.txt", "b/g.txt", "e.txt/f.txt", "h.txt")
+            self.assertListEqual(sorted(Path(d, name) for name in expected), sorted(engine.paths()))
+            self.assertNotIn(Path(d, "b", "c.txt"), engine.manifest._pages)
+
+    def test_invalidation(self):
+        """ Only the cached results the changed page might affect are dropped. """
+        with TemporaryDirectory() as d:
+            for name, text in {"linux": "linux is an os", "foo": "foo bar", "other": "economical"}.items():
+                Path(d, name + ".txt").write_text(text)
+            engine = Engine(Path(d))
+            [engine.search(query) for query in ("economical", "linux", "bar", "!oth")]
+
+            Path(d, "foo.txt").write_text("foo")  # matched "bar" before
+            engine.page_changed(Path(d, "foo.txt"))
+            Path(d, "linux.txt").write_text("linux is an economical os")  # matches "economical" now
+            engine.page_changed(Path(d, "linux.txt"))
+            self.assertListEqual(["!oth"], list(engine.states))
+            self.assertListEqual(["other", "linux"], [item.path for item in engine.search("economical")])
+            self.assertListEqual([], engine.search("bar"))
+
+            engine.title_changed("Economical notes")
+            self.assertListEqual(["!oth", "bar"], list(engine.states))
+            engine.title_changed("Othello", removed=True)
+            self.assertListEqual(["!oth", "bar"], list(engine.states))
+            engine.title_changed("other", removed=True)
+            self.assertListEqual(["bar"], list(engine.states))
+
+    def test_scan_slices(self):
+        with TemporaryDirectory() as d:
+            for name in ("a", "b", "c"):
+                Path(d, name + ".txt").write_text("foo")
+            engine = Engine(Path(d))
+            state = engine.states.set_current("foo")
+            scan = state.new_scan()
+            found = []
+            slices = engine.scan_slices(state, scan, sorted(engine.paths()), True,
+                                        lambda page, score: found.append(page), first=[Path(d, "c.txt")], budget=0)
+            self.assertGreaterEqual(len(list(slices)), 3)  # every page takes longer than the budget
+            self.assertListEqual(["c", "a", "b"], found)  # the likely page first
+            state.scan_finished(scan)
+            self.assertTrue(state.is_finished)
+
+            # the index update cannot be interrupted, the slices wait for it
+            engine.index = SimpleNamespace(update=lambda *_, **__: sleep(.2), filter=lambda paths, _: paths)
+            state = engine.states.set_current("foox")
+            slices = engine.scan_slices(state, state.new_scan(), sorted(engine.paths()), True,
+                                        lambda page, score: None, budget=.01)
+            self.assertGreater(len(list(slices)), 10)
+
+    def test_preview(self):
+        lines = ["====== Foo ======", "foo <bar> & baz", "nothing"]
+        self.assertEqual("====== <b>Foo</b> ======\n<b>foo</b> &lt;bar&gt; &amp; baz\n...",
+                         get_preview_text(lines, "foo", preview_short=True))
+
+    def test_preview_windows(self):
+        """ The preview is rendered by windows and cached. """
+        contents = "\n".join(["Title"] + [f"line {i}" + (" foo" if i % 2 else "") for i in range(300)]) + "\n"
+        page = _FileCache("page", contents, PageText(contents), 0, len(contents))
+        preview = Preview.get(page, "foo", preview_short=True)
+        self.assertEqual(301, preview.lines)
+        first = preview.render()
+        self.assertTrue(first.startswith("Title\nline 1 <b>foo</b>\nline 3 <b>foo</b>\n"))
+        self.assertEqual(Preview.window, len(preview.markup.split("\n")))
+        while preview.render() is not None:
+            pass
+        self.assertEqual(get_preview_text(contents.splitlines(), "foo", preview_short=True), preview.markup)
+        self.assertIs(preview, Preview.get(page, "foo", preview_short=True))
+
+    def test_preview_cache(self):
+        """ The previews not rendered whole hold the page contents, they count against the size limit. """
+        pages = [_FileCache(f"page{i}", "Title\n" + "foo\n" * 1000, PageText(""), 0, 0) for i in range(3)]
+        max_cached_size, Preview.max_cached_size = Preview.max_cached_size, 20000
+        try:
+            Preview._cache.clear()
+            first = Preview.get(pages[0], "foo")
+            first.render()
+            second = Preview.get(pages[1], "foo")
+            self.assertListEqual([first, second], list(Preview._cache.values()))
+            Preview.get(pages[2], "foo")
+            self.assertNotIn(first, Preview._cache.values())
+            self.assertIsNone(first.render())  # released
+            Preview.release_pending()
+            self.assertFalse(Preview._cache)
+        finally:
+            Preview.max_cached_size = max_cached_size
+
+    def test_match_offsets(self):
+        """ The scan records where the terms were found, the preview jumps to them. """
+        with TemporaryDirectory() as d:
+            contents = "Title\n" + "nothing\n" * 60 + "f**o**o bar\n" + "nothing\n" * 10 + "== Foo ==\n"
+            Path(d, "page.txt").write_text(contents)
+            Path(d, "link.txt").write_text("[[foo]]")
+            engine = Engine(Path(d))
+            engine.search("foo")
+            state = engine.states.get("foo")
+            offsets = state.match_offsets(Path(d, "page.txt"))
+            page = file_cache.get(Path(d, "page.txt"), engine.path2zim)
+            self.assertListEqual([contents.index("f**o**o"), contents.index("Foo ==")],
+                                 [page.text.offset(i) for i in offsets])
+            self.assertIsNone(state.match_offsets(Path(d, "link.txt")))  # found in the link only
+
+            Preview._cache.clear()
+            preview = Preview.get(page, "foo", preview_short=True, offsets=offsets)
+            preview.render()
+            self.assertEqual("Title\nf**o**o bar\n== <b>Foo</b> ==\n...", preview.markup)
+
 
 if __name__ == '__main__':
     main()